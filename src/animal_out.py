@@ -12,20 +12,65 @@ src.animal_out -- Machine Learning Algorithm
 
 import sys
 import os
+import copy
+import atexit
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 import time
-import pandas as datafile
+import json
+import hashlib
+import io
+import zlib
+import collections
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import style
-style.use("ggplot")
+import lazy_module
+import feature_cache
+import forest_inference
+import stage_profiler
+import pipeline_runner
+import result_writer
 
 from argparse                 import ArgumentParser
-from argparse                 import RawDescriptionHelpFormatter
-from sklearn.ensemble         import RandomForestClassifier
-from sklearn.tree             import DecisionTreeClassifier 
-from sklearn.metrics          import precision_score
-from sklearn.preprocessing    import LabelEncoder, normalize
-from sklearn.cross_validation import KFold, cross_val_score
+
+# pandas takes about half a second to import, so it is imported when first used
+datafile = lazy_module.LazyModule("pandas")
+
+###############################################################################
+#                           IMPORT LEARNERS FUNCTION
+# scikit-learn, joblib and scipy take seconds to import, while --help, the
+# prepare command or a train run whose stages are all up to date do not need
+# them. They are imported by the functions that fit or predict (pipeline
+# stages, incremental training, model artifacts) into the same globals
+# module level imports would set.
+###############################################################################
+learners_imported = False
+
+def import_learners():
+    global learners_imported, sparse, joblib, Parallel, delayed, clone, KFold, \
+           StratifiedKFold, RandomForestClassifier, ExtraTreesClassifier, \
+           GradientBoostingClassifier, DecisionTreeClassifier, HistGradientBoostingClassifier
+
+    if learners_imported:
+        return
+    from scipy                    import sparse
+    from sklearn.ensemble         import RandomForestClassifier, ExtraTreesClassifier, \
+                                         GradientBoostingClassifier
+    from sklearn.tree             import DecisionTreeClassifier 
+    from sklearn.base             import clone
+    from sklearn.model_selection  import KFold, StratifiedKFold
+    try:
+        from sklearn.ensemble         import HistGradientBoostingClassifier
+    except ImportError:
+        HistGradientBoostingClassifier = None
+    try:
+        import joblib
+        from joblib                   import Parallel, delayed
+    except ImportError:
+        from sklearn.externals        import joblib
+        from sklearn.externals.joblib import Parallel, delayed
+    learners_imported = True
 
 
 ###############################################################################
@@ -40,13 +85,102 @@ norm_data = False
 run_alg = False
 tunning_par = False
 choose_alg = False
+chunksize = 0
+fold_prediction = "best"
+n_jobs = 0
+parallel_mode = "auto"
+shared_dir = None
+shared_train = None
+pipeline_jobs = 0
+incremental = False
+date_features = False
+breed_encoding = "ordinal"
+output_precision = None
+output_format = "csv"
+out_dir = "../out"
+
+# Records time, memory and rows of each stage of a run
+profiler = stage_profiler.StageProfiler()
+
+# Batches up to this number of rows are predicted with flat forests
+flat_batch_rows = 256
+
+# Directory of the state kept between runs. Only its feature cache
+# (cache_dir/features) is limited to cache_size MB, the least recently used
+# frames being evicted. The pipeline work files (cache_dir/pipeline) and the
+# incremental training state (cache_dir/incremental) are the files of the
+# latest run, they are replaced by the next one and are not counted.
+use_cache = True
+cache_dir = "../cache"
+cache_size = 1024
+
+# Bump it every time the model artifact layout changes
+artifact_version = 1
+
+# Bump it every time the features built by get_new_file/pre_process change,
+# so that old cached frames are not reused
+feature_version = 2
 
 class rf_param_t:
     n_estimators = 200
+    # Search space used by tunning_parameters
+    search_space = {"max_features"    : ["sqrt", "log2", None],
+                    "max_depth"       : [None, 8, 16, 32],
+                    "min_samples_leaf": [1, 2, 5, 10],
+                    "n_estimators"    : [50, 100, 200, 300]}
+
+class dt_param_t:
+    search_space = {"max_features"    : ["sqrt", "log2", None],
+                    "max_depth"       : [None, 4, 8, 16, 32],
+                    "min_samples_leaf": [1, 2, 5, 10, 20]}
+
+# Search space of each algorithm tuned with -t
+search_spaces = {"RandomForest" : rf_param_t.search_space,
+                 "DecisionTrees": dt_param_t.search_space,
+                 "ExtraTrees"   : rf_param_t.search_space}
 
 class nb_param_t:
     n_estimators = 200
 
+# Output file prefix of each algorithm
+algorithm_prefix = {"RandomForest"    : "rf",
+                    "DecisionTrees"   : "dt",
+                    "ExtraTrees"      : "et",
+                    "GradientBoosting": "gb"}
+
+# Algorithm racing parameters: folds every candidate runs before it can be
+# killed and the time budget in seconds (0 means no limit)
+race_min_folds = 3
+race_budget = 0
+
+# Successive halving parameters: number of sampled configurations, the
+# fraction of them promoted at each rung (1/tune_eta) and the time budget in
+# seconds (0 means no limit)
+tune_candidates = 60
+tune_eta = 3
+tune_budget = 0
+
+# Incremental training parameters: latest train rows used to fit the new
+# trees, number of trees added to each forest by an update and the maximum
+# number of trees of each forest (the oldest ones are dropped)
+incremental_window = 20000
+incremental_trees = 50
+incremental_max_trees = 500
+
+# Breed/Color components encoding parameters: number of sparse token columns
+# and, with the frequency encoding, the minimum number of train rows of a kept
+# component
+token_width = 1024
+token_min_count = 5
+
+# Explicit dtypes used when reading files by chunks
+input_dtypes = {"AnimalID": str, "Name": str, "DateTime": str, "OutcomeType": str,\
+                "OutcomeSubtype": str, "AnimalType": str, "SexuponOutcome": str,\
+                "AgeuponOutcome": str, "Breed": str, "Color": str}
+
+# Attributes whose NaN values are not filled with the most frequent value
+nan_skip_att = ["ID", "AnimalID", "Name", "DateTime"]
+
 # Target attribute
 target_att = ["OutcomeType"]
 
@@ -56,10 +190,23 @@ id_att = ["ID"]
 # Nominal attributes drop out list. Only common attibutes for both train/test files
 useless_att_droplist = ["DateTime"]
 
+# Nominal attributes converted to numeric codes with -x
+nominal_att = ["singleColor", "singleBreed", "AnimalType", "Sex", "Neutered",\
+               "isMix", "hasName"]
+
 # features to compute prob
 attr_comp = ["singleColor", "singleBreed", "AnimalType", "Sex", "Neutered",\
              "isMix", "hasName", "nbrofColors", "DaysUponOutcome"]
 
+# DateTime features added to attr_comp with -d
+date_att = ["Hour", "Weekday", "Month", "Year", "DaysSinceEpoch"]
+
+# Format of DateTime values
+date_format = "%Y-%m-%d %H:%M:%S"
+
+# Vocabulary entry of the Breed/Color components kept by the frequency encoding
+token_key = "Tokens"
+
 
 ###############################################################################
 #                       AGE CONVERSION FUNCTION
@@ -68,7 +215,7 @@ def age_to_days(item):
     # convert item to list if it is one string
     if type(item) is str:
         item = [item]
-    ages_in_days = datafile.np.zeros(len(item))
+    ages_in_days = np.zeros(len(item))
     for i in range(len(item)):
         # check if item[i] is str
         if type(item[i]) is str:
@@ -107,6 +254,60 @@ def get_neutered(x):
     return 'unknown'
         
         
+###############################################################################
+#                       GET BREED FUNCTIONS
+# Breed must be handled as it has many different types. So we detect if it
+# is a 'Mix' breed and take only the first breed before '/' without 'Mix'
+###############################################################################
+def get_is_mix(x):
+    return "Mix" in x
+
+
+def get_single_breed(x):
+    return x.split("/")[0].split(" Mix")[0]
+
+
+###############################################################################
+#                       GET COLOR FUNCTIONS
+# Also for colors we split them, take only the first one and count them
+###############################################################################
+def get_single_color(x):
+    return x.split("/")[0]
+
+
+def get_nbr_of_colors(x):
+    return len((x.split("/")))
+
+
+###############################################################################
+#                       GET HAS NAME FUNCTION
+###############################################################################
+def get_has_name(x):
+    return type(x) is str
+
+
+###############################################################################
+#                       GET TOKENS FUNCTIONS
+# Components of a Breed or Color value, the parts between '/'. Breeds lose
+# 'Mix', so 'Labrador Retriever Mix' and 'Labrador Retriever/Pit Bull' share
+# a component. Each component is prefixed by its attribute.
+###############################################################################
+def get_breed_tokens(x):
+    if type(x) is not str:
+        return []
+    return ["Breed=" + breed.split(" Mix")[0] for breed in x.split("/")]
+
+
+def get_color_tokens(x):
+    if type(x) is not str:
+        return []
+    return ["Color=" + color for color in x.split("/")]
+
+
+# Raw attribute and components function of each tokenized attribute
+token_derivations = [("Breed", get_breed_tokens), ("Color", get_color_tokens)]
+
+
 ###############################################################################
 #                       GET DATE FUNCTION
 ###############################################################################
@@ -123,412 +324,1986 @@ def get_time_info(date_time):
     return date_time.split(" ")[1]
        
         
+###############################################################################
+#                       DATE TABLE FUNCTION
+# DateTime features of an array of DateTime strings, parsed at once with a
+# fixed format. Values that are not dates get -1 in every feature.
+###############################################################################
+def date_table(values):
+    dates = datafile.DatetimeIndex(datafile.to_datetime(values, format=date_format, \
+                                                        errors="coerce"))
+    days = (dates - datafile.Timestamp("1970-01-01")) / datafile.Timedelta(days=1)
+    table = {"Hour"          : dates.hour, \
+             "Weekday"       : dates.weekday, \
+             "Month"         : dates.month, \
+             "Year"          : dates.year, \
+             "DaysSinceEpoch": days}
+    is_date = ~np.asarray(dates.isnull())
+    return dict((name, np.where(is_date, np.asarray(values, dtype=np.float64), -1)) \
+                for name, values in table.items())
+
+
+###############################################################################
+#                       COMPILE DATE FEATURES FUNCTION
+# Timestamps repeat a lot, so only the distinct ones are parsed and the
+# results are broadcast back to all rows through the integer codes.
+###############################################################################
+def compile_date_features(column):
+    codes, uniques = datafile.factorize(column.values)
+    features = {}
+    for name, table in date_table(np.asarray(uniques, dtype=object)).items():
+        # NaN values get code -1, so their result goes in the last position
+        table = np.append(table, -1)
+        features[name] = datafile.Series(table.take(codes), index=column.index)
+    return features
+
+
+###############################################################################
+#                       AGE IN DAYS FUNCTION
+# Single value version of age_to_days, used by the feature compiler.
+###############################################################################
+def age_in_days(x):
+    return age_to_days([x])[0]
+
+
+###############################################################################
+#                       COMPILE FEATURES FUNCTION
+# Raw columns like Breed, Color or SexuponOutcome have only a few hundred
+# distinct values for thousands of rows. So we factorize the column once,
+# derive each feature only for its distinct values and broadcast the results
+# back to all rows through the integer codes. 'derivations' is a list of
+# (feature name, function) pairs and a dict of new columns is returned.
+###############################################################################
+def compile_features(column, derivations):
+    codes, uniques = datafile.factorize(column.values)
+    features = {}
+    for name, func in derivations:
+        table = [func(value) for value in uniques]
+        # NaN values get code -1, so their result goes in the last position
+        if (codes < 0).any():
+            table.append(func(np.nan))
+        table = datafile.Series(table).values
+        features[name] = datafile.Series(table.take(codes), index=column.index)
+    return features
+
+
+###############################################################################
+#                           TOKEN COLUMNS FUNCTION
+# Names of the sparse columns holding the Breed/Color components.
+###############################################################################
+def token_columns():
+    return ["Token%d" % i for i in range(token_width)]
+
+
+###############################################################################
+#                           ENCODE TOKENS FUNCTION
+# Sparse matrix (CSR) of the Breed/Color components of each row, with
+# token_width columns. With the hashed encoding a component goes to the
+# column given by its CRC32, so the width is fixed whatever the number of
+# breeds; with the frequency encoding only the components kept in the
+# vocabulary have a column and the other ones are dropped. As in
+# compile_features, components are found only once for each distinct value.
+# 'csv_file' may be a frame or a dict of value lists.
+###############################################################################
+def encode_tokens(csv_file, vocabulary):
+    if breed_encoding == "frequency":
+        positions = dict((token, i) for i, token in \
+                         enumerate(vocabulary.categories[token_key]))
+        position = positions.get
+    else:
+        position = lambda token: zlib.crc32(token.encode("utf-8")) % token_width
+
+    matrix = None
+    for column, func in token_derivations:
+        codes, uniques = datafile.factorize(np.asarray(csv_file[column], dtype=object))
+        rows, cols = [], []
+        for row, value in enumerate(uniques):
+            for token in func(value):
+                col = position(token)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        # NaN values get code -1, which is the empty last row
+        table = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), \
+                                  shape=(len(uniques) + 1, token_width))
+        column_matrix = table[codes]
+        matrix = column_matrix if matrix is None else matrix + column_matrix
+    return matrix.tocsr()
+
+
+###############################################################################
+#                           FEATURE MATRIX FUNCTION
+# Values of the attr_comp attributes of a frame given to the classifiers.
+# With a Breed/Color components encoding they are followed by the sparse
+# token columns and a CSR matrix is returned.
+###############################################################################
+def feature_matrix(csv_file, dtype=None):
+    data = csv_file[attr_comp].values
+    if dtype is not None:
+        data = data.astype(dtype)
+    if breed_encoding == "ordinal":
+        return data
+    tokens = csv_file[token_columns()].sparse.to_coo()
+    return sparse.hstack([sparse.csr_matrix(data, dtype=dtype or np.float64), tokens], \
+                         format="csr", dtype=dtype or np.float64)
+
+
 ###############################################################################
 #                    BUILD A NEW TRAIN/TEST FILE FUNCTION
 # Each task print some info and calculates spent time by itself.
 # Then split some data as the original datafile has mixed info in it.
 ###############################################################################
 def get_new_file(filename):
-    global verbose, nanfill
+    global nanfill, chunksize
+
+    # Big files are read and rebuilt in chunks
+    if chunksize > 0:
+        return get_new_file_chunked(filename)
     
     # First of all we need open/read the datafile
-    if verbose > 0:
-        print_progress("Opening %s file to rebuild it." % os.path.abspath(filename))
-        start_time = time.clock()
-    csv_file = datafile.read_csv(filename)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+    with profiler.stage("read_csv", "Opening %s file to rebuild it." % \
+                        os.path.abspath(filename)) as stage:
+        csv_file = datafile.read_csv(filename)
+        stage.rows = len(csv_file)
         
     # One of the files has a different column ID name. Fix it so that
     # both train and test have the same column name for ID    
     if "AnimalID" in csv_file.columns:
-        if verbose > 0:
-            print_progress("Adjusting ID column...")
-            start_time = time.clock()
-        csv_file=csv_file.rename(columns = {"AnimalID":"ID"})
-        csv_file["ID"] = csv_file["ID"].apply(lambda x: x.split("A")[1])
-        if verbose > 0:
-            print("--> %8.3f seconds" % (time.clock() - start_time))
+        with profiler.stage("adjust_id", "Adjusting ID column..."):
+            csv_file = adjust_id_column(csv_file)
 
     # Handling missing values
     if (nanfill == True):
-        if verbose > 0:
-            print_progress("Filliing NAN with -1...")
-            start_time = time.clock()
-        csv_file = csv_file.fillna(-1)
+        with profiler.stage("fill_nan", "Filliing NAN with -1..."):
+            csv_file = csv_file.fillna(-1)
     else:    
-        if verbose > 0:
-            print_progress("Filliing NAN with most frequent value...")
-            start_time = time.clock()
-        # We convert the csv_file in boolean values. Then we discover which 
-        # columns have or not NaN values and iterate over csv_filem to fill 
-        # with most frequent value.    
-        data_with_nan = csv_file.isnull().any()
-        data_with_nan = data_with_nan.drop(["ID", "Name", "DateTime"])
-        csv_file_aux = csv_file.dropna()
-        for column_with_nan in data_with_nan.index:
-            if (data_with_nan[column_with_nan] == True):
-                mean_value = csv_file_aux[column_with_nan].value_counts().index[0]
-                csv_file[column_with_nan] = csv_file[column_with_nan].fillna(mean_value)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+        with profiler.stage("fill_nan", "Filliing NAN with most frequent value..."):
+            fill_values = most_frequent_values(csv_file)
+            csv_file = csv_file.fillna(fill_values)
 
-    # Then we convert 'AgeuponOutcome' to unit 'days'
-    if verbose > 0:
-        print_progress("Converting age to days...")
-        start_time = time.clock()
-    feature_values = csv_file["AgeuponOutcome"].values
-    csv_file["DaysUponOutcome"] = age_to_days(feature_values)
-    csv_file.drop("AgeuponOutcome", axis=1, inplace = True)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+    # Now we have a new datafile
+    return derive_features(csv_file, True)
 
-    
-    # Split sex and neutered info in two new columns
-    if verbose > 0:
-        print_progress("Splitting sex and neutered info...")
-        start_time = time.clock()
-    csv_file["Sex"] = csv_file["SexuponOutcome"].apply(get_sex)
-    csv_file["Neutered"] = csv_file["SexuponOutcome"].apply(get_neutered)
-    csv_file.drop("SexuponOutcome", axis=1, inplace = True)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
 
+###############################################################################
+#                   BUILD A NEW TRAIN/TEST FILE BY CHUNKS FUNCTION
+# Same as get_new_file but the file is read in chunks of 'chunksize' rows
+# with explicit dtypes, so only one chunk of raw data is in memory at a time.
+# A first pass counts values over all chunks to find the most frequent ones,
+# then a second pass fills NaN and derives the features chunk by chunk.
+# Rebuilt chunks keep their text columns as categoricals, a few bytes per
+# row, and the frame is then assembled one column at a time, so the chunks
+# are not held next to a full copy of the frame. The frame itself has the
+# same text columns as get_new_file gives: vocabulary codes are only known
+# in pre_process.
+###############################################################################
+def get_new_file_chunked(filename):
+    with profiler.stage("rebuild_chunks", "Rebuilding %s by chunks..." % \
+                        os.path.basename(filename)) as stage:
+        chunks = [compact_chunk(chunk) for chunk in iter_new_file_chunks(filename)]
+        csv_file = concat_compact_chunks(chunks)
+        stage.rows = len(csv_file)
 
-    # Generates a new column with boolean info 'isMix' for breed
-    if verbose > 0:
-        print_progress("Detecting if is a Mix breed...")
-        start_time = time.clock()
-    csv_file["isMix"] = csv_file["Breed"].apply(lambda x: "Mix" in x)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+    return csv_file
 
 
-    # Breed must be handled as it has many different types. So we
-    # take only the first breed before '/' and remove 'Mix'
-    if verbose > 0:
-        print_progress("Getting first breed and removing Mix...")
-        start_time = time.clock()
-    csv_file["singleBreed"] = csv_file["Breed"].apply(lambda x: x.split("/")[0])
-    csv_file["singleBreed"] = csv_file["singleBreed"].apply(lambda x: x.split(" Mix")[0])
-    csv_file.drop("Breed", axis=1, inplace = True)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+###############################################################################
+#                       COMPACT CHUNK FUNCTION
+# Text columns of a rebuilt chunk as categoricals. The dtypes they had are
+# kept in 'text_dtypes' to restore them.
+###############################################################################
+def compact_chunk(chunk):
+    text_dtypes = {}
+    for column in chunk.columns:
+        if not datafile.api.types.is_numeric_dtype(chunk[column]):
+            text_dtypes[column] = chunk[column].dtype
+            chunk[column] = chunk[column].astype("category")
+    return chunk, text_dtypes
+
+
+###############################################################################
+#                   CONCAT COMPACT CHUNKS FUNCTION
+# Same frame as concat of the original chunks. Each column is taken out of
+# all chunks, joined and restored to its dtype before the next one, so the
+# memory of the chunks is released while the frame grows.
+###############################################################################
+def concat_compact_chunks(chunks):
+    if not chunks:
+        return datafile.DataFrame()
+    columns = list(chunks[0][0].columns)
+    text_dtypes = chunks[0][1]
+    csv_file = datafile.DataFrame(index=datafile.RangeIndex(sum(len(chunk) for chunk, _ in chunks)))
+    for column in columns:
+        parts = [chunk.pop(column) for chunk, _ in chunks]
+        if column in text_dtypes:
+            values = datafile.api.types.union_categoricals(parts).astype(text_dtypes[column])
+        else:
+            values = np.concatenate([part.values for part in parts])
+        del parts
+        csv_file[column] = values
+    return csv_file
+
+
+###############################################################################
+#                       ITERATE NEW FILE CHUNKS FUNCTION
+# Generator of the rebuilt chunks of a file, used by get_new_file_chunked
+# and by the predict command.
+###############################################################################
+def iter_new_file_chunks(filename):
+    global nanfill, chunksize
+
+    fill_values = -1
+    if (nanfill == False):
+        with profiler.stage("count_values", "Counting values of %s by chunks..." % \
+                            os.path.basename(filename)) as stage:
+            value_counts = {}
+            columns_with_nan = set()
+            stage.rows = 0
+            for chunk in datafile.read_csv(filename, dtype=input_dtypes, chunksize=chunksize):
+                count_values(chunk, value_counts, columns_with_nan)
+                stage.rows += len(chunk)
+            fill_values = dict((column, value_counts[column].sort_values(ascending=False).index[0]) \
+                               for column in columns_with_nan)
+
+    chunks = datafile.read_csv(filename, dtype=input_dtypes, chunksize=chunksize)
+    while True:
+        with profiler.stage("read_chunk") as stage:
+            chunk = next(chunks, None)
+            if chunk is not None:
+                stage.rows = len(chunk)
+        if chunk is None:
+            break
+        if "AnimalID" in chunk.columns:
+            chunk = adjust_id_column(chunk)
+        chunk = chunk.fillna(fill_values)
+        yield derive_features(chunk, False)
+
+
+###############################################################################
+#                       ADJUST ID COLUMN FUNCTION
+# One of the files has a different column ID name and its values start
+# with an 'A'. Fix it so that both train and test have the same ID column.
+###############################################################################
+def adjust_id_column(csv_file):
+    csv_file = csv_file.rename(columns = {"AnimalID":"ID"})
+    csv_file["ID"] = csv_file["ID"].apply(lambda x: x.split("A")[1])
+    return csv_file
+
+
+###############################################################################
+#                       MOST FREQUENT VALUES FUNCTION
+# We discover which columns have or not NaN values and take the most
+# frequent value of each one among the rows without any NaN value.
+###############################################################################
+def most_frequent_values(csv_file):
+    value_counts = {}
+    columns_with_nan = set()
+    count_values(csv_file, value_counts, columns_with_nan)
+    return dict((column, value_counts[column].index[0]) for column in columns_with_nan)
+
+
+###############################################################################
+#                           COUNT VALUES FUNCTION
+# Accumulates in 'value_counts' the values found in rows without NaN and in
+# 'columns_with_nan' the columns having NaN values. Rows are selected by a
+# mask, so no copy of the whole file without NaN is built.
+###############################################################################
+def count_values(csv_file, value_counts, columns_with_nan):
+    complete_rows = csv_file.notnull().all(axis=1).values
+    has_nan = csv_file.isnull().any()
+    for column in csv_file.columns:
+        if column in nan_skip_att:
+            continue
+        if has_nan[column] == True:
+            columns_with_nan.add(column)
+        counts = csv_file[column][complete_rows].value_counts()
+        if column in value_counts:
+            counts = value_counts[column].add(counts, fill_value=0)
+        value_counts[column] = counts
+
+
+###############################################################################
+#                           DERIVE FEATURES FUNCTION
+# Splits the mixed info of a train/test file in new attributes. Stages are
+# always profiled, but their progress is shown only if 'show_progress'.
+###############################################################################
+def derive_features(csv_file, show_progress):
+    # Progress message of a stage, if it is shown
+    def message(text):
+        return text if show_progress else None
+
+    # Then we convert 'AgeuponOutcome' to unit 'days'. The age strings
+    # repeat a lot, so each distinct value is converted only once.
+    with profiler.stage("derive_age", message("Converting age to days..."), \
+                        len(csv_file)):
+        features = compile_features(csv_file["AgeuponOutcome"], \
+                                    [("DaysUponOutcome", age_in_days)])
+        csv_file["DaysUponOutcome"] = features["DaysUponOutcome"]
+        csv_file.drop("AgeuponOutcome", axis=1, inplace = True)
 
     
-    # Also for colors we split them and take only the first one
-    if verbose > 0:
-        print_progress("Getting first color...")
-        start_time = time.clock()
-    csv_file["singleColor"] = csv_file["Color"].apply(lambda x: x.split("/")[0])
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
-        
-        
-    # Count colors in each animal
-    if verbose > 0:
-        print_progress("Counting color for each animal ...")
-        start_time = time.clock()
-    csv_file["nbrofColors"] = csv_file["Color"].apply(lambda x: len((x.split("/"))))
-    csv_file.drop("Color", axis=1, inplace = True)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+    # Split sex and neutered info in two new columns
+    with profiler.stage("derive_sex", message("Splitting sex and neutered info..."), \
+                        len(csv_file)):
+        features = compile_features(csv_file["SexuponOutcome"], \
+                                    [("Sex",      get_sex), \
+                                     ("Neutered", get_neutered)])
+        csv_file["Sex"]      = features["Sex"]
+        csv_file["Neutered"] = features["Neutered"]
+        csv_file.drop("SexuponOutcome", axis=1, inplace = True)
+
+
+    # Breed must be handled as it has many different types. So we detect
+    # if it is a 'Mix' breed and take only the first breed before '/'
+    # without 'Mix'
+    with profiler.stage("derive_breed", message("Getting first breed and detecting Mix..."), \
+                        len(csv_file)):
+        features = compile_features(csv_file["Breed"], \
+                                    [("isMix",       get_is_mix), \
+                                     ("singleBreed", get_single_breed)])
+        csv_file["isMix"]       = features["isMix"]
+        csv_file["singleBreed"] = features["singleBreed"]
+        # Components encodings need the whole value in pre_process
+        if (breed_encoding == "ordinal"):
+            csv_file.drop("Breed", axis=1, inplace = True)
+
+    
+    # Also for colors we split them, take only the first one and count
+    # colors in each animal
+    with profiler.stage("derive_color", message("Getting first color and counting colors..."), \
+                        len(csv_file)):
+        features = compile_features(csv_file["Color"], \
+                                    [("singleColor", get_single_color), \
+                                     ("nbrofColors", get_nbr_of_colors)])
+        csv_file["singleColor"] = features["singleColor"]
+        csv_file["nbrofColors"] = features["nbrofColors"]
+        if (breed_encoding == "ordinal"):
+            csv_file.drop("Color", axis=1, inplace = True)
         
                             
     # Create a atribute with info if the animal has a name
-    if verbose > 0:
-        print_progress("Has the animal a name?")
-        start_time = time.clock()
-    csv_file["hasName"] = csv_file["Name"].apply(lambda x: type(x) is str)
-    csv_file.drop("Name", axis=1, inplace = True)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+    with profiler.stage("derive_name", message("Has the animal a name?"), len(csv_file)):
+        features = compile_features(csv_file["Name"], \
+                                    [("hasName", get_has_name)])
+        csv_file["hasName"] = features["hasName"]
+        csv_file.drop("Name", axis=1, inplace = True)
+
+
+    # Hour, weekday, month, year and days since epoch of the outcome.
+    # DateTime itself is dropped by pre_process.
+    if (date_features == True):
+        with profiler.stage("derive_date", message("Getting date and time features..."), \
+                            len(csv_file)):
+            features = compile_date_features(csv_file["DateTime"])
+            for name in date_att:
+                csv_file[name] = features[name]
         
         
-    # Now we have a new datafile
     return csv_file    
    
    
+###############################################################################
+#                       CATEGORY VOCABULARY CLASS
+# Keeps the sorted distinct values of each nominal attribute. It is fitted
+# once on the train file and then maps train, test and any future file to the
+# same codes. Values not seen in the train file go to an unknown bucket, whose
+# code is the number of known values. Codes are stored in the smallest
+# unsigned integer type able to hold them (uint8 for up to 255 values).
+###############################################################################
+class CategoryVocabulary(object):
+
+    def __init__(self, categories=None):
+        self.categories = categories if categories is not None else {}
+
+
+    def is_fitted(self):
+        return len(self.categories) > 0
+
+
+    # Learns the distinct values of the given columns
+    def fit(self, csv_file, columns):
+        for column in columns:
+            if column in csv_file.columns:
+                self.categories[column] = np.unique(csv_file[column].values).tolist()
+        return self
+
+
+    # Learns the 'width' most frequent Breed/Color components seen in at
+    # least 'min_count' rows
+    def fit_tokens(self, csv_file, width, min_count):
+        counts = collections.Counter()
+        for column, func in token_derivations:
+            for value, count in csv_file[column].value_counts().items():
+                for token in func(value):
+                    counts[token] += count
+        tokens = sorted((token for token, count in counts.items() if count >= min_count), \
+                        key=lambda token: (-counts[token], token))
+        self.categories[token_key] = tokens[:width]
+        return self
+
+
+    # Replaces known columns of csv_file by their codes
+    def transform(self, csv_file):
+        for column, values in self.categories.items():
+            if column in csv_file.columns:
+                csv_file[column] = self.encode(column, csv_file[column].values)
+        return csv_file
+
+
+    # Maps values of one column to codes, unknown values to the last code
+    def encode(self, column, values):
+        known = self.categories[column]
+        codes = datafile.Index(known).get_indexer(values)
+        codes[codes < 0] = len(known)
+        return codes.astype(np.min_scalar_type(len(known)))
+
+
+    # Short hash of the vocabulary, used as part of cache keys
+    def digest(self):
+        return hashlib.sha1(json.dumps(self.categories, sort_keys=True)\
+                            .encode("utf-8")).hexdigest()
+
+
+    def save(self, filename):
+        with open(filename, "w") as vocabulary_file:
+            json.dump(self.categories, vocabulary_file, sort_keys=True)
+
+
+    @staticmethod
+    def load(filename):
+        with open(filename) as vocabulary_file:
+            return CategoryVocabulary(json.load(vocabulary_file))
+
+
 ###############################################################################
 #                           PRE_PROCESS FUNCTION
 ###############################################################################
-def pre_process(csv_file):
-    global verbose, nanfill, nominal2numeric, norm_data
+def pre_process(csv_file, vocabulary, show_progress=True):
+    global nanfill, nominal2numeric, norm_data
  
+    # Progress message of a stage, if it is shown
+    def message(text):
+        return text if show_progress else None
  
-    if verbose > 0:
-        print_progress("Removing useless attributes...")
-        start_time = time.clock()
-    csv_file.drop(useless_att_droplist, axis=1, inplace = True)
-    if "OutcomeSubtype" in csv_file.columns:
-        csv_file.drop("OutcomeSubtype", axis=1, inplace = True)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+    # The vocabulary is fitted only once, on the train file, so the same
+    # category gets the same code in train and test files
+    fit_vocabulary = not vocabulary.is_fitted()
+
+    with profiler.stage("drop_useless", message("Removing useless attributes...")):
+        csv_file.drop(useless_att_droplist, axis=1, inplace = True)
+        if "OutcomeSubtype" in csv_file.columns:
+            csv_file.drop("OutcomeSubtype", axis=1, inplace = True)
+
+
+    # Breed/Color components go to sparse token columns, which take memory
+    # only for the components of each row
+    if (breed_encoding != "ordinal"):
+        import_learners()
+        if breed_encoding == "frequency" and token_key not in vocabulary.categories:
+            if not fit_vocabulary:
+                raise ValueError("Vocabulary has no Breed/Color components, fit it again " \
+                                 "with the frequency encoding")
+            with profiler.stage("fit_tokens", message("Fitting breed and color components...")):
+                vocabulary.fit_tokens(csv_file, token_width, token_min_count)
+
+        with profiler.stage("encode_tokens", message("Encoding breed and color components..."), \
+                            len(csv_file)):
+            tokens = datafile.DataFrame.sparse.from_spmatrix(encode_tokens(csv_file, vocabulary), \
+                                                             index=csv_file.index, \
+                                                             columns=token_columns())
+            csv_file = datafile.concat([csv_file.drop(["Breed", "Color"], axis=1), tokens], \
+                                       axis=1)
             
 
     if (nominal2numeric == True):
-        if verbose > 0:
-            print_progress("Converting nominal to numeric data...")
-            start_time = time.clock()
-        to_number = LabelEncoder()
-        csv_file["singleColor"] = to_number.fit_transform(csv_file['singleColor'])
-        csv_file["singleBreed"] = to_number.fit_transform(csv_file['singleBreed'])
-        csv_file["AnimalType"]  = to_number.fit_transform(csv_file['AnimalType'])
-        csv_file["Sex"]         = to_number.fit_transform(csv_file['Sex'])
-        csv_file["Neutered"]    = to_number.fit_transform(csv_file['Neutered'])
-        csv_file["isMix"]       = to_number.fit_transform(csv_file['isMix'])
-        csv_file["hasName"]     = to_number.fit_transform(csv_file['hasName'])
-        if "OutcomeType" in csv_file.columns:
-            csv_file["OutcomeType"] = to_number.fit_transform(csv_file['OutcomeType'])
-        if verbose > 0:
-            print("--> %8.3f seconds" % (time.clock() - start_time))
+        if fit_vocabulary:
+            with profiler.stage("fit_vocabulary", \
+                                message("Fitting nominal attributes vocabulary...")):
+                vocabulary.fit(csv_file, nominal_att + target_att)
+
+        with profiler.stage("encode_nominal", message("Converting nominal to numeric data..."), \
+                            len(csv_file)):
+            vocabulary.transform(csv_file)
             
             # TODO: Vamos implementar a normalização ???
             
-        return csv_file
+    return csv_file
         
         
 ###############################################################################
-#                           RUN_ALGORITHM FUNCTION
+#                       PREPROCESS OPTIONS FUNCTION
+# All options that change the output of get_new_file/pre_process. They are
+# parameters of the pre_process pipeline stages and saved in model artifacts.
 ###############################################################################
-def tunning_parameters():
-    parameter = 0
+def preprocess_options():
+    return {"feature_version" : feature_version, \
+            "nanfill"         : nanfill, \
+            "date_features"   : date_features, \
+            "breed_encoding"  : breed_encoding, \
+            "token_width"     : token_width, \
+            "token_min_count" : token_min_count, \
+            "nominal2numeric" : nominal2numeric, \
+            "norm_data"       : norm_data}
 
 
 ###############################################################################
-#                       CHOOSE THE BEST ALGORITHM FUNCTION
+#                       REBUILD OPTIONS FUNCTION
+# Options that change the output of get_new_file. They are part of the cache
+# key of the rebuilt frames.
 ###############################################################################
-def choose_best_algorithm():
-    alg_chosen = ''
+def rebuild_options():
+    # Rebuilt frames are stored before pre_process, unlike old cache entries
+    return {"feature_version" : feature_version, \
+            "nanfill"         : nanfill, \
+            "date_features"   : date_features, \
+            "raw_breed_color" : breed_encoding != "ordinal", \
+            "frame"           : "rebuilt"}
 
-    return alg_chosen
 
 ###############################################################################
-#                         RUN_RANDOM_FOREST FUNCTION
+#                       LOAD REBUILT FILE FUNCTION
+# Rebuilds a train/test file with get_new_file. The result is kept in the
+# feature cache, so next runs with the same file and options skip parsing.
+# Pipeline runs do not use it: their rebuild stages keep the rebuilt frames
+# in the pipeline work directory, which would store them twice.
 ###############################################################################
-def run_random_forest(train_file, test_file):
-    global verbose
+def load_rebuilt_file(filename):
+    global use_cache, cache_dir, cache_size
+
+    if use_cache == True:
+        features_dir = os.path.join(cache_dir, "features")
+        if not os.path.isdir(features_dir):
+            os.makedirs(features_dir)
+        cache = feature_cache.FeatureCache(features_dir, cache_size << 20)
+        key = cache.key([filename], rebuild_options())
 
+        with profiler.stage("cache_load", "Looking for %s in cache..." % \
+                            os.path.basename(filename)) as stage:
+            cached = cache.load(key)
+            if cached is not None:
+                stage.rows = len(cached[0])
+        if cached is not None:
+            return cached[0]
+
+    csv_file = get_new_file(filename)
+
+    if use_cache == True:
+        with profiler.stage("cache_store", "Storing %s in cache..." % \
+                            os.path.basename(filename), len(csv_file)):
+            cache.store(key, csv_file)
+    return csv_file
+
+
+###############################################################################
+#                           SHARE ARRAYS FUNCTION
+# Saves arrays in .npy files and loads them back memory-mapped. When such
+# an array is sent to parallel workers only its file name is pickled, so all
+# workers read the same pages instead of each one getting its own copy.
+# Files go to /dev/shm when it has room for them, to a temporary directory
+# on disk otherwise (/dev/shm of a Docker container has 64 MB by default),
+# and are removed at exit.
+###############################################################################
+def share_arrays(arrays):
+    global shared_dir
+
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    if shared_dir is None:
+        base_dir = None
+        if os.path.isdir("/dev/shm"):
+            shm_stat = os.statvfs("/dev/shm")
+            # Some room is left for other users of /dev/shm
+            if sum(array.nbytes for array in arrays) * 2 < shm_stat.f_bavail * shm_stat.f_frsize:
+                base_dir = "/dev/shm"
+        shared_dir = tempfile.mkdtemp(prefix="animal_out-", dir=base_dir)
+        atexit.register(shutil.rmtree, shared_dir, True)
+    shared = []
+    for array in arrays:
+        handle, filename = tempfile.mkstemp(suffix=".npy", dir=shared_dir)
+        os.close(handle)
+        np.save(filename, array)
+        shared.append(np.load(filename, mmap_mode="r"))
+    return shared
+
+
+###############################################################################
+#                       REMOVE SHARED ARRAYS FUNCTION
+# Pipeline stages run in processes that end without calling atexit handlers,
+# so they remove their shared arrays themselves. Memory-mapped arrays still
+# in use stay readable until they are released.
+###############################################################################
+def remove_shared_arrays():
+    global shared_dir, shared_train
+
+    if shared_dir is not None:
+        shutil.rmtree(shared_dir, True)
+        shared_dir = None
+    shared_train = None
+
+
+###############################################################################
+#                       SHARED TRAIN DATA FUNCTION
+# Feature matrix and target of the train file as shared arrays. Features
+# are stored as float32, the type trees work with, so fold workers only
+# copy the rows of their fold. A sparse matrix shares its three arrays.
+# Tuning, racing and cross-validation of the same frame reuse its shared
+# arrays, and sharing another frame removes them, so there is only one copy.
+###############################################################################
+def shared_train_data(train_file):
+    global shared_train
+
+    key = (train_file.shape, list(train_file.columns), breed_encoding)
+    if shared_train is not None and shared_train[0] is train_file and shared_train[1] == key:
+        return shared_train[2], shared_train[3]
+    remove_shared_arrays()
+
+    train_data = feature_matrix(train_file, np.float32)
     target = train_file["OutcomeType"].values
-    train_data = train_file[attr_comp].values
+    if sparse.issparse(train_data):
+        data, indices, indptr, target = share_arrays([train_data.data, train_data.indices, \
+                                                      train_data.indptr, target])
+        train_data = sparse.csr_matrix((data, indices, indptr), shape=train_data.shape)
+    else:
+        train_data, target = share_arrays([train_data, target])
+    shared_train = (train_file, key, train_data, target)
+    return train_data, target
+
+
+###############################################################################
+#                           TOTAL CORES FUNCTION
+###############################################################################
+def total_cores():
+    global n_jobs
+    if n_jobs > 0:
+        return n_jobs
+    return multiprocessing.cpu_count()
+
+
+###############################################################################
+#                           PARALLEL PLAN FUNCTION
+# Single CPU scheduling policy for all parallel stages. A stage runs
+# 'n_tasks' independent tasks (folds, configurations or classifiers) and
+# each task may use several threads (forest trees). This function returns
+# (task_jobs, inner_jobs) so that task_jobs * inner_jobs never goes beyond
+# the available cores:
+#   folds: one core per task, trees run sequentially
+#   trees: one task at a time, all cores for the trees
+#   split: about square root of the cores for tasks, the rest for trees
+#   auto : as many tasks as possible, the remaining cores for the trees
+###############################################################################
+def parallel_plan(stage, n_tasks):
+    global verbose, parallel_mode
+
+    cores = total_cores()
+    n_tasks = max(n_tasks, 1)
+    if parallel_mode == "folds":
+        task_jobs = min(n_tasks, cores)
+    elif parallel_mode == "trees":
+        task_jobs = 1
+    elif parallel_mode == "split":
+        task_jobs = min(n_tasks, max(int(np.sqrt(cores)), 1))
+    else:
+        task_jobs = min(n_tasks, cores)
+    inner_jobs = 1 if parallel_mode == "folds" else max(cores // task_jobs, 1)
 
-    # Gets/Split samples for trainning/test
-    if verbose > 0:
-        start_time = time.clock()
-    if verbose > 0:
-        print_progress("Gets/Split samples for trainning/test")
-    kf = KFold(len(train_file), n_folds=10, shuffle=False)
     if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+        print("CPU plan for %s: %d tasks x %d threads on %d cores" % \
+              (stage, task_jobs, inner_jobs, cores))
+    return task_jobs, inner_jobs
 
 
-    # Run cross-validation to tune parameters
-    print ("Tunning Random Forest classifier...")
-    score_result = 0.0
-    for nbr_estimators in range(100, 400, 100):  
-        if nbr_estimators == 0: 
-            nbr_estimators = 1  
-        classif = RandomForestClassifier(n_estimators = nbr_estimators, n_jobs = -1, \
-                                         max_features="sqrt", random_state=1000)
-        scores = cross_val_score(classif,train_data, target, scoring='accuracy',\
-                                 cv=10, n_jobs=-1)
-        if score_result < scores.mean():
-            score_result = scores.mean()
-            best_classif = classif
-            best_estimator = nbr_estimators
-        print ("Tunning:  n_estimator = %d / acurácia = %6.2f" %(nbr_estimators, scores.mean()*100))
-    print ("Best n_estimator = %d / acurácia = %6.2f" %(best_estimator, score_result*100))
+###############################################################################
+#                           WITH JOBS FUNCTION
+# Sets the number of threads of classifiers that have n_jobs.
+###############################################################################
+def with_jobs(classif, jobs):
+    if "n_jobs" in classif.get_params():
+        classif.set_params(n_jobs = jobs)
+    return classif
 
 
-    #iterate through the training and test cross validation segments and
-    #run the classifier on each one, aggregating the results into a list
-    score_result = 0.0
-    for traincv, testcv in kf:
-        if verbose > 0:
-            print_progress("Performing fitting...")
-            start_time = time.clock()
-        fit_result = best_classif.fit(train_data[traincv], target[traincv])
-        if verbose > 0:
-            print("--> %8.3f seconds" % (time.clock() - start_time))
-        
+###############################################################################
+#                        TUNNING PARAMETERS FUNCTION
+# Successive halving search. 'tune_candidates' configurations are sampled
+# from the search space and scored with 3-fold cross-validation on a small
+# subset of the train rows. Only the best 1/tune_eta configurations are
+# promoted to the next rung, which uses tune_eta times more rows, until the
+# last rung uses all rows. As each rung has tune_eta times less configurations
+# and tune_eta times more rows, the next rung is expected to cost about the
+# same as the last one. If it would not finish inside 'tune_budget' seconds
+# the search stops with the best configuration so far. Configurations are
+# scored in batches of one per core, so the budget is also checked inside a
+# rung.
+###############################################################################
+def tunning_parameters(classif, search_space, train_file):
+    global verbose, tune_candidates, tune_eta, tune_budget
+
+    start_search = time.time()
+    train_data, target = shared_train_data(train_file)
+    random_state = np.random.RandomState(1000)
+
+    # Sample the configurations to evaluate
+    names = sorted(search_space.keys())
+    configs = [dict(zip(names, values)) for values in \
+               itertools.product(*[search_space[name] for name in names])]
+    random_state.shuffle(configs)
+    configs = configs[:tune_candidates]
+
+    # Rows are taken in a random order, so each rung subset holds the
+    # previous one
+    rows = random_state.permutation(len(train_file))
+    nbr_rungs = 1
+    while tune_eta ** nbr_rungs < len(configs):
+        nbr_rungs += 1
+
+    print ("Tunning %s with successive halving..." % type(classif).__name__)
+    for rung in range(nbr_rungs):
+        rung_start = time.time()
+        nbr_rows = len(rows) // (tune_eta ** (nbr_rungs - rung - 1))
+        rung_rows = rows[:max(nbr_rows, 30)]
+        # Folds index the shared train data, so the rung rows are not copied
+        folds = [(rung_rows[traincv], rung_rows[testcv]) for traincv, testcv in \
+                 StratifiedKFold(n_splits=3, shuffle=True, random_state=1000)\
+                     .split(rung_rows, target[rung_rows])]
+        scores = []
+        batch_size, inner_jobs = parallel_plan("Rung %d" % rung, len(configs))
+        for batch in range(0, len(configs), batch_size):
+            scores += Parallel(n_jobs=batch_size)(
+                delayed(score_configuration)(with_jobs(clone(classif).set_params(**config), \
+                                                       inner_jobs), \
+                                             train_data, target, folds)
+                for config in configs[batch:batch + batch_size])
+            if tune_budget > 0 and time.time() - start_search > tune_budget:
+                break
+        configs = configs[:len(scores)]
+
+        ranking = np.argsort(scores, kind="mergesort")[::-1]
+        best_config, best_score = configs[ranking[0]], scores[ranking[0]]
         if verbose > 0:
-            print_progress("Calculating training score...")
-            start_time = time.clock()
-        score = fit_result.score(train_data[testcv], target[testcv])
+            print("Rung %d: %d configurations on %d rows --> %8.3f seconds" % \
+                  (rung, len(configs), len(rung_rows), time.time() - rung_start))
+
+        # Promote the best configurations while there is time to score them
+        configs = [configs[i] for i in ranking[:max(len(configs) // tune_eta, 1)]]
+        spent = time.time() - start_search
+        if tune_budget > 0 and spent + (time.time() - rung_start) > tune_budget:
+            if rung < nbr_rungs - 1:
+                print ("Time budget of %d seconds reached" % tune_budget)
+            break
+
+    print ("Best parameters = %s / acurácia = %6.2f" % (best_config, best_score*100))
+    return best_config
+
+
+###############################################################################
+#                       SCORE CONFIGURATION FUNCTION
+# Mean accuracy of a classifier over the given cross-validation folds.
+###############################################################################
+def score_configuration(classif, train_data, target, folds):
+    scores = []
+    for traincv, testcv in folds:
+        classif.fit(train_data[traincv], target[traincv])
+        scores.append(classif.score(train_data[testcv], target[testcv]))
+    return np.mean(scores)
+
+
+###############################################################################
+#                       CANDIDATE CLASSIFIERS FUNCTION
+# Classifiers raced by choose_best_algorithm. Histogram-based gradient
+# boosting needs a recent scikit-learn and dense features, otherwise the
+# classic one is used.
+###############################################################################
+def candidate_classifiers():
+    if HistGradientBoostingClassifier is not None and breed_encoding == "ordinal":
+        boosting = HistGradientBoostingClassifier(random_state=1000)
+    else:
+        boosting = GradientBoostingClassifier(random_state=1000)
+    return [("RandomForest",     RandomForestClassifier(n_estimators=rf_param_t.n_estimators, \
+                                                        max_features="sqrt", random_state=1000)),
+            ("DecisionTrees",    DecisionTreeClassifier(max_features="sqrt", random_state=1000)),
+            ("ExtraTrees",       ExtraTreesClassifier(n_estimators=rf_param_t.n_estimators, \
+                                                      max_features="sqrt", random_state=1000)),
+            ("GradientBoosting", boosting)]
+
+
+###############################################################################
+#                       CHOOSE THE BEST ALGORITHM FUNCTION
+# Races the candidate classifiers fold by fold over a 10-fold
+# cross-validation. The survivors of each fold are fitted in parallel. After
+# race_min_folds folds, a candidate is killed when its paired fold scores
+# are below the leader ones by more than two standard errors. The race ends
+# when only one candidate is left, all folds are done or race_budget seconds
+# are spent. The candidate with best mean accuracy is chosen.
+###############################################################################
+def choose_best_algorithm(train_file):
+    global verbose, race_min_folds, race_budget
+
+    start_race = time.time()
+    train_data, target = shared_train_data(train_file)
+    folds = StratifiedKFold(n_splits=10, shuffle=True, random_state=1000)\
+                .split(np.zeros(len(target)), target)
+
+    candidates = candidate_classifiers()
+    alive  = [name for name, _ in candidates]
+    scores = dict((name, []) for name in alive)
+    times  = dict((name, 0.0) for name in alive)
+    status = dict((name, "") for name in alive)
+
+    print ("Racing classifiers...")
+    for fold, (traincv, testcv) in enumerate(folds):
+        candidate_jobs, inner_jobs = parallel_plan("Race fold %d" % (fold + 1), len(alive))
+        results = Parallel(n_jobs=candidate_jobs)(
+            delayed(fit_and_score)(with_jobs(clone(classif), inner_jobs), \
+                                   train_data, target, traincv, testcv)
+            for name, classif in candidates if name in alive)
+        for name, (score, seconds) in zip(alive, results):
+            scores[name].append(score)
+            times[name] += seconds
+
+        # Kill the candidates that clearly lose against the leader: their
+        # mean score difference is over twice its standard error, computed
+        # with the sample standard deviation of the fold differences
+        if fold + 1 >= race_min_folds:
+            leader = max(alive, key=lambda name: np.mean(scores[name]))
+            for name in list(alive):
+                diff = np.array(scores[leader]) - np.array(scores[name])
+                if name != leader and \
+                   diff.mean() > 2 * diff.std(ddof=1) / np.sqrt(len(diff)):
+                    alive.remove(name)
+                    status[name] = "killed at fold %d" % (fold + 1)
         if verbose > 0:
-            print("--> %8.3f seconds" % (time.clock() - start_time))
+            print("Fold %d: %s --> %8.3f seconds" % \
+                  (fold + 1, ", ".join(alive), time.time() - start_race))
 
-        if score_result < score:
-            score_result = score
-            if verbose > 0:
-                print_progress("Performing prediction on test data...")
-                start_time = time.clock()
-            pred_prob = fit_result.predict_proba(test_file[attr_comp].values)
-            if verbose > 0:
-                print("--> %8.3f seconds" % (time.clock() - start_time))
+        if len(alive) == 1:
+            break
+        if race_budget > 0 and time.time() - start_race > race_budget:
+            print ("Time budget of %d seconds reached" % race_budget)
+            break
 
-    return score_result, test_file["ID"].values, pred_prob
+    alg_chosen = max(alive, key=lambda name: np.mean(scores[name]))
+    status[alg_chosen] = "chosen"
+
+    # Timing/accuracy report
+    print ("%-20s %5s %10s %10s  %s" % ("Classifier", "Folds", "Accuracy", "Seconds", "Status"))
+    for name, _ in candidates:
+        print ("%-20s %5d %10.2f %10.3f  %s" % (name, len(scores[name]), \
+               np.mean(scores[name])*100, times[name], status[name]))
+
+    return alg_chosen
 
 
 ###############################################################################
-#                         RUN_DECISION_TREES FUNCTION
+#                           FIT AND SCORE FUNCTION
+# Fits a classifier on one fold and returns its accuracy and fitting time.
 ###############################################################################
-def run_decision_trees(train_file, test_file):
-    global verbose
+def fit_and_score(classif, train_data, target, traincv, testcv):
+    start_time = time.time()
+    classif.fit(train_data[traincv], target[traincv])
+    score = classif.score(train_data[testcv], target[testcv])
+    return score, time.time() - start_time
 
-    target = train_file["OutcomeType"].values
-    train_data = train_file[attr_comp].values
+
+###############################################################################
+#                       GROW FOREST ON FOLD FUNCTION
+# Fits a warm_start forest on one cross-validation fold adding trees until
+# each n_estimators of the grid is reached. Returns the fold accuracy for
+# each grid point and the fitted forest.
+###############################################################################
+def grow_forest_on_fold(classif, train_data, target, traincv, testcv, estimators_grid, \
+                        model_dir):
+    scores = []
+    for nbr_estimators in estimators_grid:
+        classif.set_params(n_estimators = nbr_estimators)
+        classif.fit(train_data[traincv], target[traincv])
+        scores.append(classif.score(train_data[testcv], target[testcv]))
+    return scores, dump_fold_model(classif, model_dir)
+
+
+###############################################################################
+#                       DUMP FOLD MODEL FUNCTION
+# Fold workers save their model in 'model_dir' and return its file name
+# instead of the model. Forests of all folds together take gigabytes, so the
+# parent loads only the models its prediction mode needs (see
+# FoldModels.add_files). 'model_dir' is on disk, not in /dev/shm.
+###############################################################################
+def dump_fold_model(model, model_dir):
+    handle, filename = tempfile.mkstemp(suffix=".pkl", dir=model_dir)
+    os.close(handle)
+    joblib.dump(model, filename)
+    return filename
+
+
+###############################################################################
+#                           FIRST TREES FUNCTION
+# Returns a forest with only the first nbr_estimators trees of 'forest'.
+# With a fixed random_state it is the forest that would be fitted with
+# n_estimators = nbr_estimators.
+###############################################################################
+def first_trees(forest, nbr_estimators):
+    forest = copy.copy(forest)
+    forest.estimators_ = forest.estimators_[:nbr_estimators]
+    forest.n_estimators = nbr_estimators
+    forest.warm_start = False
+    return forest
+
+
+###############################################################################
+#                           FOLD MODELS CLASS
+# Registry of the models fitted on each cross-validation fold and of their
+# out-of-fold scores. Test predictions come from these models, either the
+# best fold model or the average of all fold models (ensemble), so nothing
+# is fitted again after cross-validation.
+###############################################################################
+class FoldModels(object):
+
+    def __init__(self):
+        self.models = []
+        self.scores = []
+        self.flat_models = None
+
+
+    def add(self, model, score):
+        self.models.append(model)
+        self.scores.append(score)
+
+
+    # Adds the models saved by dump_fold_model. Only the models used by the
+    # given prediction mode are loaded, through 'transform' if given, one at
+    # a time. The others are None until prune drops them.
+    def add_files(self, filenames, scores, mode, transform=None):
+        best = len(self.scores) + int(np.argmax(scores))
+        for filename, score in zip(filenames, scores):
+            model = None
+            if mode == "ensemble" or len(self.scores) == best:
+                model = joblib.load(filename)
+                if transform is not None:
+                    model = transform(model)
+            self.add(model, score)
+
+
+    # First fold with the highest score
+    def best_fold(self):
+        return int(np.argmax(self.scores))
+
+
+    # Training score reported for the given prediction mode
+    def training_score(self, mode):
+        if mode == "ensemble":
+            return float(np.mean(self.scores))
+        return self.scores[self.best_fold()]
+
+
+    # Drops the models not used by the given prediction mode
+    def prune(self, mode):
+        if mode != "ensemble":
+            best = self.best_fold()
+            self.models = [self.models[best]]
+            self.scores = [self.scores[best]]
+
+
+    # Compiles tree models into flat forests. They are used for batches of up
+    # to 'flat_batch_rows' rows, where they are faster than predict_proba.
+    def compile(self):
+        if all(forest_inference.is_supported(model) for model in self.models):
+            self.flat_models = [forest_inference.FlatForest(model) for model in self.models]
+
+
+    def predict_proba(self, data, mode):
+        models = self.models
+        if self.flat_models is not None and not sparse.issparse(data) and \
+           data.shape[0] <= flat_batch_rows:
+            models = self.flat_models
+        if mode == "ensemble":
+            pred_prob = models[0].predict_proba(data)
+            for model in models[1:]:
+                pred_prob += model.predict_proba(data)
+            return pred_prob / len(models)
+        return models[self.best_fold()].predict_proba(data)
+
+
+###############################################################################
+#                       PREDICT TEST FILE FUNCTION
+# Predicts the test file with the fold models of a classifier.
+###############################################################################
+def predict_test_file(fold_models, test_file):
+    global fold_prediction
+
+    with profiler.stage("predict_test", "Performing prediction on test data...", \
+                        len(test_file)):
+        fold_models.prune(fold_prediction)
+        for model in fold_models.models:
+            with_jobs(model, total_cores())
+        pred_prob = fold_models.predict_proba(feature_matrix(test_file), fold_prediction)
+
+    return fold_models.training_score(fold_prediction), test_file["ID"].values, pred_prob, \
+           fold_models
+
+
+###############################################################################
+#                         RUN_RANDOM_FOREST FUNCTION
+###############################################################################
+def run_random_forest(train_file, test_file, params=None):
+    with profiler.stage("share_data", rows=len(train_file)):
+        train_data, target = shared_train_data(train_file)
 
     # Gets/Split samples for trainning/test
-    if verbose > 0:
-        start_time = time.clock()
-    if verbose > 0:
-        print_progress("Gets/Split samples for trainning/test")
-    kf = KFold(len(train_file), n_folds=10, shuffle=False)
-    if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+    with profiler.stage("split_folds", "Gets/Split samples for trainning/test"):
+        skf = list(StratifiedKFold(n_splits=10, shuffle=False).split(np.zeros(len(target)), target))
+
+
+    # Run cross-validation to tune parameters. Each fold grows a single
+    # forest: it is fitted with the first n_estimators, scored, and then the
+    # next trees are added to it with warm_start. As random_state is fixed
+    # the trees are the same as if each forest was fitted from scratch.
+    # With parameters from tunning_parameters the grid is only their
+    # n_estimators.
+    print ("Tunning Random Forest classifier...")
+    estimators_grid = [max(nbr_estimators, 1) for nbr_estimators in range(100, 400, 100)]
+    fold_jobs, tree_jobs = parallel_plan("Random Forest", len(skf))
+    classif = RandomForestClassifier(n_jobs = tree_jobs, max_features="sqrt", \
+                                     random_state=1000, warm_start=True)
+    if params is not None:
+        params = dict(params)
+        estimators_grid = [params.pop("n_estimators", rf_param_t.n_estimators)]
+        classif.set_params(**params)
+    model_dir = tempfile.mkdtemp(prefix="animal_out-folds-")
+    try:
+        with profiler.stage("cross_validation", rows=len(train_file)):
+            fold_results = Parallel(n_jobs=fold_jobs)(
+                delayed(grow_forest_on_fold)(clone(classif), train_data, target, \
+                                             traincv, testcv, estimators_grid, model_dir)
+                for traincv, testcv in skf)
+        scores = np.array([fold_scores for fold_scores, _ in fold_results]).mean(axis=0)
+
+        score_result = 0.0
+        for i, (nbr_estimators, score) in enumerate(zip(estimators_grid, scores)):
+            if score_result < score:
+                score_result = score
+                best_index = i
+                best_estimator = nbr_estimators
+            print ("Tunning:  n_estimator = %d / acurácia = %6.2f" %(nbr_estimators, score*100))
+        print ("Best n_estimator = %d / acurácia = %6.2f" %(best_estimator, score_result*100))
+
+
+        # The fold forests cut to the best number of trees are the final models
+        with profiler.stage("load_fold_models"):
+            fold_models = FoldModels()
+            fold_models.add_files([filename for _, filename in fold_results], \
+                                  [fold_scores[best_index] for fold_scores, _ in fold_results], \
+                                  fold_prediction, lambda forest: first_trees(forest, best_estimator))
+    finally:
+        shutil.rmtree(model_dir, True)
+
+    return predict_test_file(fold_models, test_file)
+
+
+###############################################################################
+#                         RUN_DECISION_TREES FUNCTION
+###############################################################################
+def run_decision_trees(train_file, test_file, params=None):
+    with profiler.stage("share_data", rows=len(train_file)):
+        train_data, target = shared_train_data(train_file)
+
+    # Gets/Split samples for trainning/test
+    with profiler.stage("split_folds", "Gets/Split samples for trainning/test"):
+        kf = KFold(n_splits=10, shuffle=False).split(target)
 
 
     # Create the classifier
     classif = DecisionTreeClassifier(max_features="sqrt", random_state=1000)
+    if params is not None:
+        classif.set_params(**params)
 
     #iterate through the training and test cross validation segments and
-    #run the classifier on each one, aggregating the results into a list
-    score_result = 0.0
+    #run the classifier on each one, keeping each fold model
+    fold_models = FoldModels()
     for traincv, testcv in kf:
-        if verbose > 0:
-            print_progress("Performing fitting...")
-            start_time = time.clock()
-        fit_result = classif.fit(train_data[traincv], target[traincv])
-        if verbose > 0:
-            print("--> %8.3f seconds" % (time.clock() - start_time))
+        with profiler.stage("fit_fold", "Performing fitting...", len(traincv)):
+            fit_result = clone(classif).fit(train_data[traincv], target[traincv])
         
-        if verbose > 0:
-            print_progress("Calculating training score...")
-            start_time = time.clock()
-        score = fit_result.score(train_data[testcv], target[testcv])
-        if verbose > 0:
-            print("--> %8.3f seconds" % (time.clock() - start_time))
+        with profiler.stage("score_fold", "Calculating training score...", len(testcv)):
+            score = fit_result.score(train_data[testcv], target[testcv])
+        fold_models.add(fit_result, score)
+
+    return predict_test_file(fold_models, test_file)
 
-        if score_result < score:
-            score_result = score
-            if verbose > 0:
-                print_progress("Performing prediction on test data...")
-                start_time = time.clock()
-            pred_prob = fit_result.predict_proba(test_file[attr_comp].values)
-            if verbose > 0:
-                print("--> %8.3f seconds" % (time.clock() - start_time))
 
-    return score_result, test_file["ID"].values, pred_prob
+###############################################################################
+#                         RUN_CLASSIFIER FUNCTION
+# Cross-validates any other classifier, keeping each fold model.
+###############################################################################
+def run_classifier(classif, train_file, test_file):
+    with profiler.stage("share_data", rows=len(train_file)):
+        train_data, target = shared_train_data(train_file)
+
+    with profiler.stage("cross_validation", "Performing fitting of %s..." % \
+                        type(classif).__name__, len(train_file)):
+        folds = list(StratifiedKFold(n_splits=10, shuffle=False).split(np.zeros(len(target)), target))
+        fold_jobs, inner_jobs = parallel_plan(type(classif).__name__, len(folds))
+        model_dir = tempfile.mkdtemp(prefix="animal_out-folds-")
+        try:
+            fold_results = Parallel(n_jobs=fold_jobs)(
+                delayed(fit_on_fold)(with_jobs(clone(classif), inner_jobs), \
+                                     train_data, target, traincv, testcv, model_dir)
+                for traincv, testcv in folds)
+
+            fold_models = FoldModels()
+            fold_models.add_files([filename for filename, _ in fold_results], \
+                                  [score for _, score in fold_results], fold_prediction)
+        finally:
+            shutil.rmtree(model_dir, True)
+
+    return predict_test_file(fold_models, test_file)
+
+
+###############################################################################
+#                           FIT ON FOLD FUNCTION
+# Fits a classifier on one fold and returns the file it is saved in, see
+# dump_fold_model, with its accuracy.
+###############################################################################
+def fit_on_fold(classif, train_data, target, traincv, testcv, model_dir):
+    classif.fit(train_data[traincv], target[traincv])
+    return dump_fold_model(classif, model_dir), classif.score(train_data[testcv], target[testcv])
 
 
 ###############################################################################
-#                           PRINT PROGRESS FUNCTION
+#                           RUN ALGORITHM FUNCTION
+# Runs one of the algorithms of algorithm_prefix by its name.
 ###############################################################################
-def print_progress(msg):
-# line length
-# 1      10        20        30        40        50        60        70       80
-# 345678901234567890123456789012345678901234567890123456789012345678901234567890
-    msglen = len(msg)
-    fillspaces = 50 - msglen 
-    msg = msg + fillspaces * ' '
-    print ("%s" % msg),    
+def run_algorithm(name, train_file, test_file, params=None):
+    if name == "RandomForest":
+        return run_random_forest(train_file, test_file, params)
+    if name == "DecisionTrees":
+        return run_decision_trees(train_file, test_file, params)
+    classif = dict(candidate_classifiers())[name]
+    if params is not None:
+        classif.set_params(**params)
+    return run_classifier(classif, train_file, test_file)
 
 
 ###############################################################################
 #                           SHOW_RESULTS FUNCTION
 ###############################################################################
-def print_results(classifier_text, id_test, pred_prob, training_score, out_filename):
+def print_results(classifier_text, id_test, pred_prob, training_score, out_filename, \
+                  score_text="training accuracy"):
     global verbose
 
     print
     print
-    print (classifier_text + " training accuracy: %.2f" % (training_score * 100.0))    
+    print (classifier_text + " " + score_text + ": %.2f" % (training_score * 100.0))    
 
+    with profiler.stage("write_results", "Writing " + classifier_text + " output file...", \
+                        len(id_test)):
+        result_writer.write_results(out_filename, id_test, pred_prob, output_precision, \
+                                    total_cores())
     if verbose > 0:
-        start_time = time.clock()
-        print_progress("Writing " + classifier_text + " output file...")
-    datafile.DataFrame({"ID"             : id_test, \
-                        "Adoption"       : pred_prob[:,0], \
-                        "Died"           : pred_prob[:,1], \
-                        "Euthanasia"     : pred_prob[:,2], \
-                        "Return_to_owner": pred_prob[:,3], \
-                        "Transfer"       : pred_prob[:,4]  \
-                        }, columns=["ID","Adoption","Died","Euthanasia",\
-                                    "Return_to_owner","Transfer"]
-                       ).to_csv(out_filename, index=False)
+        print("Done!")
+
+
+###############################################################################
+#                           RESULT FILENAME FUNCTION
+# Output file of an algorithm, whose extension gives its format.
+###############################################################################
+def result_filename(prefix):
+    return os.path.join(out_dir, "%s_result.%s" % (prefix, output_format))
+
+
+###############################################################################
+#                       SAVE MODEL ARTIFACT FUNCTION
+# A model artifact is a directory with everything needed to score new files
+# without retraining: the fold models (model.pkl), the vocabulary of
+# nominal attributes (vocabulary.json) and the feature configuration
+# (config.json). model.pkl is loaded into memory: scikit-learn trees copy
+# their node arrays when they are unpickled, so they cannot stay mapped.
+###############################################################################
+def save_model_artifact(artifact_dir, algorithm, fold_models, vocabulary):
+    global fold_prediction
+
+    with profiler.stage("save_artifact", "Saving %s model artifact..." % algorithm):
+        if not os.path.isdir(artifact_dir):
+            os.makedirs(artifact_dir)
+        config = {"artifact_version": artifact_version, \
+                  "algorithm"       : algorithm, \
+                  "fold_prediction" : fold_prediction, \
+                  "attr_comp"       : attr_comp, \
+                  "options"         : preprocess_options()}
+        with open(os.path.join(artifact_dir, "config.json"), "w") as config_file:
+            json.dump(config, config_file, indent=2, sort_keys=True)
+        vocabulary.save(os.path.join(artifact_dir, "vocabulary.json"))
+        joblib.dump({"models": fold_models.models, "scores": fold_models.scores}, \
+                    os.path.join(artifact_dir, "model.pkl"))
+
+
+###############################################################################
+#                       LOAD MODEL ARTIFACT FUNCTION
+# Loads an artifact and restores its feature configuration. Returns its
+# config, vocabulary and fold models.
+###############################################################################
+def load_model_artifact(artifact_dir):
+    global nanfill, nominal2numeric, norm_data, date_features, breed_encoding, token_width, \
+           token_min_count, attr_comp
+
+    import_learners()
+    with profiler.stage("load_artifact", "Loading model artifact..."):
+        with open(os.path.join(artifact_dir, "config.json")) as config_file:
+            config = json.load(config_file)
+        if config["artifact_version"] != artifact_version or \
+           config["options"]["feature_version"] != feature_version:
+            raise ValueError("Model artifact %s was built by another version, train it again" \
+                             % artifact_dir)
+        nanfill         = config["options"]["nanfill"]
+        nominal2numeric = config["options"]["nominal2numeric"]
+        norm_data       = config["options"]["norm_data"]
+        date_features   = config["options"].get("date_features", False)
+        breed_encoding  = config["options"].get("breed_encoding", "ordinal")
+        token_width     = config["options"].get("token_width", token_width)
+        token_min_count = config["options"].get("token_min_count", token_min_count)
+        attr_comp       = config["attr_comp"]
+        vocabulary  = CategoryVocabulary.load(os.path.join(artifact_dir, "vocabulary.json"))
+        saved_models = joblib.load(os.path.join(artifact_dir, "model.pkl"))
+        fold_models = FoldModels()
+        for model, model_score in zip(saved_models["models"], saved_models["scores"]):
+            fold_models.add(model, model_score)
+
+    return config, vocabulary, fold_models
+
+
+###############################################################################
+#                           SCORE FUNCTION
+# Scores a new intake file with a model artifact. The file is read, rebuilt
+# and predicted in batches of 'chunksize' rows, and each batch is appended
+# to the output file, so memory does not depend on the file size.
+###############################################################################
+def score(artifact_dir, filename, out_filename):
+    global verbose, chunksize
+
+    config, vocabulary, fold_models = load_model_artifact(artifact_dir)
+    for model in fold_models.models:
+        with_jobs(model, total_cores())
+    if chunksize <= flat_batch_rows:
+        fold_models.compile()
+
+    start_time = time.time()
+    nbr_rows = 0
+    with result_writer.ResultWriter(out_filename, output_precision, total_cores()) as writer:
+        for chunk in iter_new_file_chunks(filename):
+            chunk = pre_process(chunk, vocabulary, False)
+            with profiler.stage("predict_batch", rows=len(chunk)):
+                pred_prob = fold_models.predict_proba(feature_matrix(chunk), \
+                                                      config["fold_prediction"])
+            with profiler.stage("write_batch", rows=len(chunk)):
+                writer.write(chunk["ID"].values, pred_prob)
+            nbr_rows += len(chunk)
     if verbose > 0:
-        print("--> %8.3f seconds" % (time.clock() - start_time))
+        print("%d rows of %s scored with %s model --> %8.3f seconds" % \
+              (nbr_rows, os.path.basename(filename), config["algorithm"], \
+               time.time() - start_time))
+    return 0
+
+
+###############################################################################
+#                           PIPELINE SETTINGS FUNCTIONS
+# Global options given to every pipeline stage. Each stage sets them again
+# in its own process. Stages running at the same time share the cores.
+###############################################################################
+pipeline_globals = ["verbose", "nanfill", "nominal2numeric", "norm_data", "date_features", \
+                    "breed_encoding", "token_width", "token_min_count", "attr_comp", "chunksize", "fold_prediction", "n_jobs", "parallel_mode", \
+                    "use_cache", "cache_dir", "cache_size", "race_budget", "tune_budget", \
+                    "output_precision", "output_format"]
+
+def pipeline_settings(stage_jobs):
+    settings = dict((name, globals()[name]) for name in pipeline_globals)
+    settings["n_jobs"] = max(total_cores() // stage_jobs, 1)
+    return settings
+
+
+def apply_settings(settings):
+    globals().update(settings)
+
+
+###############################################################################
+#                           PIPELINE STAGE FUNCTIONS
+# Each pipeline stage reads its inputs from files and writes its outputs to
+# files, so it can run in any process and be skipped when nothing changed.
+###############################################################################
+def rebuild_stage(stage):
+    apply_settings(stage.settings)
+    get_new_file(stage.inputs[0]).to_pickle(stage.outputs[0])
+
+
+def vocabulary_stage(stage):
+    apply_settings(stage.settings)
+    if stage.params["given"]:
+        vocabulary = CategoryVocabulary.load(stage.inputs[0])
+    else:
+        train_file = datafile.read_pickle(stage.inputs[0])
+        with profiler.stage("fit_vocabulary", "Fitting nominal attributes vocabulary..."):
+            vocabulary = CategoryVocabulary().fit(train_file, nominal_att + target_att)
+            if breed_encoding == "frequency":
+                vocabulary.fit_tokens(train_file, token_width, token_min_count)
+    vocabulary.save(stage.outputs[0])
+
+
+def pre_process_stage(stage):
+    apply_settings(stage.settings)
+    vocabulary = CategoryVocabulary()
+    if len(stage.inputs) > 1:
+        vocabulary = CategoryVocabulary.load(stage.inputs[1])
+    pre_process(datafile.read_pickle(stage.inputs[0]), vocabulary).to_pickle(stage.outputs[0])
+
+
+def race_stage(stage):
+    apply_settings(stage.settings)
+    import_learners()
+    try:
+        algorithm = choose_best_algorithm(datafile.read_pickle(stage.inputs[0]))
+    finally:
+        remove_shared_arrays()
+    with open(stage.outputs[0], "w") as race_file:
+        json.dump({"algorithm": algorithm}, race_file)
+
+
+def train_stage(stage):
+    apply_settings(stage.settings)
+    import_learners()
+    algorithm  = stage.params["algorithm"]
+    train_file = datafile.read_pickle(stage.inputs[0])
+    test_file  = datafile.read_pickle(stage.inputs[1])
+    try:
+        params = None
+        if stage.params["tunning"] and algorithm in search_spaces:
+            classif = dict(candidate_classifiers())[algorithm]
+            params = tunning_parameters(classif, search_spaces[algorithm], train_file)
+        train_score, id_test, pred_prob, fold_models = \
+            run_algorithm(algorithm, train_file, test_file, params)
+    finally:
+        remove_shared_arrays()
+    joblib.dump((train_score, id_test, pred_prob), stage.outputs[0])
+    joblib.dump(fold_models, stage.outputs[1])
+
+
+def write_stage(stage):
+    apply_settings(stage.settings)
+    import_learners()
+    train_score, id_test, pred_prob = joblib.load(stage.inputs[0])
+    print_results(stage.params["algorithm"], id_test, pred_prob, train_score, stage.outputs[0])
+
+
+def save_stage(stage):
+    apply_settings(stage.settings)
+    import_learners()
+    vocabulary = CategoryVocabulary()
+    if len(stage.inputs) > 1:
+        vocabulary = CategoryVocabulary.load(stage.inputs[1])
+    save_model_artifact(os.path.dirname(stage.outputs[0]), stage.params["algorithm"], \
+                        joblib.load(stage.inputs[0]), vocabulary)
+
+
+###############################################################################
+#                           ADD DATA STAGES FUNCTION
+# Stages building the train/test frames: both files are rebuilt at the same
+# time, the vocabulary is fitted on the train file (or taken from the given
+# vocabulary file) and then both frames are pre-processed at the same time.
+# Returns the names of the train and test frame files.
+###############################################################################
+def add_data_stages(runner, work_dir, train_filename, test_filename, vocabulary_filename):
+    settings = pipeline_settings(runner.max_workers)
+    work_file = lambda name: os.path.join(work_dir, name)
+
+    for name, filename in [("train", train_filename), ("test", test_filename)]:
+        runner.add(pipeline_runner.Stage("rebuild_" + name, rebuild_stage, [filename], \
+                                         [work_file(name + "_rebuilt.pkl")], \
+                                         rebuild_options(), settings))
+
+    vocabulary_inputs = []
+    if (nominal2numeric == True):
+        given = vocabulary_filename is not None and os.path.isfile(vocabulary_filename)
+        runner.add(pipeline_runner.Stage("fit_vocabulary", vocabulary_stage, \
+                                         [vocabulary_filename if given else \
+                                          work_file("train_rebuilt.pkl")], \
+                                         [work_file("vocabulary.json")], \
+                                         {"given": given, \
+                                          "tokens": [token_width, token_min_count] \
+                                                    if breed_encoding == "frequency" else None}, \
+                                         settings))
+        vocabulary_inputs = [work_file("vocabulary.json")]
+
+    for name in ["train", "test"]:
+        runner.add(pipeline_runner.Stage("pre_process_" + name, pre_process_stage, \
+                                         [work_file(name + "_rebuilt.pkl")] + vocabulary_inputs, \
+                                         [work_file(name + ".pkl")], \
+                                         preprocess_options(), settings))
+    return work_file("train.pkl"), work_file("test.pkl")
+
+
+###############################################################################
+#                       ADD ALGORITHM STAGES FUNCTION
+# Stages training each algorithm, writing its output file and saving its
+# model artifact. The stages of different algorithms run at the same time.
+###############################################################################
+def add_algorithm_stages(runner, work_dir, algorithms, train_frame, test_frame, save_model):
+    settings = pipeline_settings(runner.max_workers)
+    vocabulary_inputs = []
+    if "fit_vocabulary" in runner.stages:
+        vocabulary_inputs = runner.stages["fit_vocabulary"].outputs
+
+    for algorithm in algorithms:
+        prefix = algorithm_prefix[algorithm]
+        predictions = os.path.join(work_dir, "%s_predictions.pkl" % prefix)
+        models      = os.path.join(work_dir, "%s_models.pkl" % prefix)
+        runner.add(pipeline_runner.Stage("train_" + prefix, train_stage, \
+                                         [train_frame, test_frame], [predictions, models], \
+                                         {"algorithm"      : algorithm, \
+                                          "attr_comp"      : attr_comp, \
+                                          "fold_prediction": fold_prediction, \
+                                          "tunning"        : tunning_par, \
+                                          "tune_budget"    : tune_budget, \
+                                          "tune_candidates": tune_candidates, \
+                                          "tune_eta"       : tune_eta}, settings))
+        runner.add(pipeline_runner.Stage("write_" + prefix, write_stage, [predictions], \
+                                         [result_filename(prefix)], \
+                                         {"algorithm": algorithm, \
+                                          "precision": output_precision}, settings))
+        if save_model:
+            artifact_dir = os.path.join(save_model, prefix)
+            runner.add(pipeline_runner.Stage("save_" + prefix, save_stage, \
+                                             [models] + vocabulary_inputs, \
+                                             [os.path.join(artifact_dir, name) for name in \
+                                              ["config.json", "vocabulary.json", "model.pkl"]], \
+                                             {"algorithm"       : algorithm, \
+                                              "fold_prediction" : fold_prediction, \
+                                              "artifact_version": artifact_version, \
+                                              "options"         : preprocess_options(), \
+                                              "attr_comp"       : attr_comp}, settings))
+
+
+###############################################################################
+#                           READ NEW ROWS FUNCTION
+# Reads the complete lines of a CSV file after byte 'offset' (or all lines if
+# offset is 0). Returns them as a frame with the file header and the offset
+# of the first byte not read.
+###############################################################################
+def read_new_rows(filename, offset):
+    with open(filename, "rb") as input_file:
+        header = input_file.readline()
+        offset = max(offset, len(header))
+        input_file.seek(offset)
+        data = input_file.read()
+    # A line being appended right now is left for the next run
+    data = data[:data.rfind(b"\n") + 1]
+    return datafile.read_csv(io.BytesIO(header + data)), offset + len(data)
+
+
+###############################################################################
+#                           FILE PREFIX DIGEST FUNCTION
+# SHA-1 of the first 'offset' bytes of a file.
+###############################################################################
+def file_prefix_digest(filename, offset):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as input_file:
+        while offset > 0:
+            block = input_file.read(min(offset, 1 << 20))
+            if not block:
+                break
+            digest.update(block)
+            offset -= len(block)
+    return digest.hexdigest()
+
+
+###############################################################################
+#                           REBUILD ROWS FUNCTION
+# Same as get_new_file for rows already read, with the given NaN fill values.
+###############################################################################
+def rebuild_rows(csv_file, fill_values):
+    if "AnimalID" in csv_file.columns:
+        csv_file = adjust_id_column(csv_file)
+    return derive_features(csv_file.fillna(fill_values), False)
+
+
+###############################################################################
+#                       INCREMENTAL TRAINER CLASS
+# Keeps in 'state_dir' what a train file produced until now: the offset and
+# checksum of the processed prefix, the NaN fill values, the vocabulary, the
+# pre-processed train rows (one file per update) and the fold models. When
+# the file only got new rows appended, only these rows are rebuilt, and each
+# forest gets new trees fitted on the latest rows.
+###############################################################################
+class IncrementalTrainer(object):
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.state = None
+        if os.path.isfile(self.path("state.json")):
+            with open(self.path("state.json")) as state_file:
+                self.state = json.load(state_file)
+
+
+    def path(self, name):
+        return os.path.join(self.state_dir, name)
+
+
+    # Whether 'filename' starts with the processed rows and nothing that
+    # changes the processed rows or the models changed. A given vocabulary
+    # must be the one the rows were encoded with, which is also the case of
+    # the vocabulary file written by the previous run.
+    def can_update(self, filename, config, vocabulary_digest):
+        return self.state is not None and self.state["config"] == config and \
+               vocabulary_digest in (None, self.state.get("vocabulary")) and \
+               os.path.getsize(filename) >= self.state["offset"] and \
+               file_prefix_digest(filename, self.state["offset"]) == self.state["prefix_digest"]
+
+
+    # Starts a new state after a full rebuild
+    def reset(self, config, fill_values, vocabulary_digest):
+        if os.path.isdir(self.state_dir):
+            shutil.rmtree(self.state_dir)
+        os.makedirs(self.state_dir)
+        self.state = {"config": config, "fill_values": fill_values, "parts": [], \
+                      "offset": 0, "prefix_digest": None, "rows": 0, \
+                      "vocabulary": vocabulary_digest}
+
+
+    # Stores the pre-processed rows read up to 'offset'
+    def add_rows(self, filename, train_file, offset):
+        name = "train-%05d.pkl" % len(self.state["parts"])
+        train_file.to_pickle(self.path(name))
+        self.state["parts"].append([name, len(train_file)])
+        self.state["rows"] += len(train_file)
+        self.state["offset"] = offset
+        self.state["prefix_digest"] = file_prefix_digest(filename, offset)
+
+
+    # Latest 'nbr_rows' train rows. It starts earlier if needed so that each
+    # class has at least one row, as all trees of a forest must know all
+    # classes.
+    def window(self, nbr_rows, classes):
+        frames, window_rows = [], 0
+        missing = set(classes)
+        for name, part_rows in reversed(self.state["parts"]):
+            if window_rows >= nbr_rows and not missing:
+                break
+            frames.insert(0, datafile.read_pickle(self.path(name)))
+            window_rows += part_rows
+            missing -= set(frames[0]["OutcomeType"].values)
+        window = datafile.concat(frames, ignore_index=True)
+        target = window["OutcomeType"].values
+        start = max(len(window) - nbr_rows, 0)
+        for value in classes:
+            rows = np.flatnonzero(target == value)
+            if len(rows) > 0:
+                start = min(start, rows[-1])
+        return window.iloc[start:]
+
+
+    def save(self, vocabulary, fold_models):
+        vocabulary.save(self.path("vocabulary.json"))
+        joblib.dump(fold_models, self.path("models.pkl"))
+        with open(self.path("state.json"), "w") as state_file:
+            json.dump(self.state, state_file, indent=1, sort_keys=True)
+
+
+    def load(self):
+        return CategoryVocabulary.load(self.path("vocabulary.json")), \
+               joblib.load(self.path("models.pkl"))
+
+
+###############################################################################
+#                           ADD TREES FUNCTION
+# Adds 'nbr_trees' trees fitted on the given rows to a fitted forest and
+# drops its oldest trees beyond 'max_trees'.
+###############################################################################
+def add_trees(forest, train_data, target, nbr_trees, max_trees, random_state):
+    new_forest = clone(forest).set_params(n_estimators=nbr_trees, warm_start=False, \
+                                          random_state=random_state)
+    new_forest.fit(train_data, target)
+    if not np.array_equal(new_forest.classes_, forest.classes_):
+        raise ValueError("New trees must be fitted on rows of all classes")
+    forest.estimators_ = (list(forest.estimators_) + new_forest.estimators_)[-max_trees:]
+    forest.n_estimators = len(forest.estimators_)
+    forest.warm_start = False
+    return forest
+
+
+###############################################################################
+#                           RUN INCREMENTAL FUNCTION
+# Incremental mode of the Random Forest. The first run, a run after the
+# configuration or the already processed rows changed, or a run given a
+# vocabulary file other than the vocabulary of the processed rows, is a full
+# rebuild and cross-validates the forest as usual. The next runs only rebuild
+# the rows appended to the train file, measure the accuracy of the current
+# model on them and add incremental_trees trees, fitted on the latest
+# incremental_window rows, to each fold forest. Appended rows are filled with
+# the most frequent values of the full rebuild.
+###############################################################################
+def run_incremental(train_filename, test_filename, vocabulary_filename, save_model):
+    global verbose, use_cache, cache_dir, tunning_par, incremental_window, incremental_trees, \
+           incremental_max_trees
+
+    import_learners()
+    trainer = IncrementalTrainer(os.path.join(cache_dir, "incremental"))
+    given_vocabulary = None
+    if vocabulary_filename and os.path.isfile(vocabulary_filename):
+        given_vocabulary = CategoryVocabulary.load(vocabulary_filename)
+    config = {"options"        : preprocess_options(), \
+              "fold_prediction": fold_prediction, \
+              "tunning"        : tunning_par}
+
+    new_rows = None
+    if use_cache == True and trainer.can_update(train_filename, config, \
+                                                given_vocabulary and given_vocabulary.digest()):
+        with profiler.stage("read_new_rows", "Reading new rows of %s..." % \
+                            os.path.basename(train_filename)) as stage:
+            new_rows, offset = read_new_rows(train_filename, trainer.state["offset"])
+            stage.rows = len(new_rows)
+        vocabulary, fold_models = trainer.load()
+        with profiler.stage("rebuild_new_rows", "Rebuilding new rows...", len(new_rows)):
+            new_rows = pre_process(rebuild_rows(new_rows, trainer.state["fill_values"]), \
+                                   vocabulary, False)
+        classes = fold_models.models[0].classes_
+        if not set(np.unique(new_rows["OutcomeType"].values)) <= set(classes):
+            print("New outcome values were found, rebuilding everything")
+            new_rows = None
+
+    if new_rows is None:
+        # Full rebuild, NaN are filled as get_new_file does
+        with profiler.stage("read_new_rows", "Reading all rows of %s..." % \
+                            os.path.basename(train_filename)) as stage:
+            train_file, offset = read_new_rows(train_filename, 0)
+            stage.rows = len(train_file)
+        score_text = "training accuracy"
+        if "AnimalID" in train_file.columns:
+            train_file = adjust_id_column(train_file)
+        fill_values = -1 if nanfill == True else most_frequent_values(train_file)
+        train_file = rebuild_rows(train_file, fill_values)
+        vocabulary = given_vocabulary or CategoryVocabulary()
+        train_file = pre_process(train_file, vocabulary)
+        test_file = pre_process(load_rebuilt_file(test_filename), vocabulary)
+
+        params = None
+        if (tunning_par == True):
+            params = tunning_parameters(dict(candidate_classifiers())["RandomForest"], \
+                                        search_spaces["RandomForest"], train_file)
+        train_score, id_test, pred_prob, fold_models = \
+            run_random_forest(train_file, test_file, params)
+        remove_shared_arrays()
+        trainer.reset(config, fill_values, vocabulary.digest())
+        trainer.add_rows(train_filename, train_file, offset)
+    else:
+        test_file = pre_process(load_rebuilt_file(test_filename), vocabulary)
+        if len(new_rows) > 0:
+            # Accuracy of the current model on rows it has never seen. It is
+            # the reported score, the cross-validation score is the one of the
+            # last full rebuild.
+            pred_prob = fold_models.predict_proba(feature_matrix(new_rows), fold_prediction)
+            accuracy = np.mean(classes.take(pred_prob.argmax(axis=1)) == \
+                               new_rows["OutcomeType"].values)
+            score_text = "accuracy on %d new rows before the update" % len(new_rows)
+
+            trainer.add_rows(train_filename, new_rows, offset)
+            window = trainer.window(incremental_window, classes)
+            with profiler.stage("add_trees", "Adding trees fitted on %d rows..." % len(window), \
+                                len(window)):
+                for i, forest in enumerate(fold_models.models):
+                    add_trees(with_jobs(forest, total_cores()), feature_matrix(window), \
+                              window["OutcomeType"].values, incremental_trees, \
+                              incremental_max_trees, 1000 + trainer.state["rows"] + i)
+        else:
+            print("No new rows in %s" % os.path.basename(train_filename))
+            score_text = "training accuracy of the last full rebuild"
+        train_score, id_test, pred_prob, fold_models = predict_test_file(fold_models, test_file)
+        if len(new_rows) > 0:
+            train_score = accuracy
+
+    trainer.save(vocabulary, fold_models)
+    if vocabulary_filename and given_vocabulary is None and vocabulary.is_fitted():
+        vocabulary.save(vocabulary_filename)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    print_results("RandomForest", id_test, pred_prob, train_score, result_filename("rf"), \
+                  score_text)
+    if save_model:
+        save_model_artifact(os.path.join(save_model, "rf"), "RandomForest", fold_models, \
+                            vocabulary)
     if verbose > 0:
-        print("Done!")
+        print("%d train rows, %d trees per forest" % \
+              (trainer.state["rows"], len(fold_models.models[0].estimators_)))
 
 
-    
 ###############################################################################
-#                               MAIN FUNCTION
+#                       ADD DATA ARGUMENTS FUNCTION
+# Options of the prepare and train commands: input files, features and how
+# the pipeline runs.
 ###############################################################################
-def main(argv=None): # IGNORE:C0111
+def add_data_arguments(parser):
+    parser.add_argument("--train"     , dest="train"     , default="../data/train.csv", help="train CSV file (default: ../data/train.csv)")
+    parser.add_argument("--test"      , dest="test"      , default="../data/test.csv", help="test CSV file (default: ../data/test.csv)")
+    parser.add_argument("-m", dest="norm_data" , default=False, action="store_true", help="normalize numeric data")
+    parser.add_argument("-n", dest="nanfill"   , default=False, action="store_true", help="fills NaN values with -1 instead most frequent value")
+    parser.add_argument("-v", dest="verbose"   , default=0    , action="count",      help="shows script execution steps")
+    parser.add_argument("-d", dest="date_features", default=False, action="store_true", help="adds hour, weekday, month, year and days since epoch of DateTime to the features")
+    parser.add_argument("--breed-encoding", dest="breed_encoding", default="ordinal", choices=["ordinal", "hashed", "frequency"], help="encodes Breed/Color as the code of their first component (ordinal) or adds all their components as sparse hashed or most frequent token columns (default: ordinal)")
+    parser.add_argument("--token-width", dest="token_width", default=1024, type=int, help="sparse token columns of the hashed/frequency Breed/Color encodings (default: 1024)")
+    parser.add_argument("--min-token-count", dest="token_min_count", default=5, type=int, help="train rows a Breed/Color component needs to get a column with --breed-encoding frequency (default: 5)")
+    parser.add_argument("-x", dest="nom2num"   , default=False, action="store_true", help="convert nominal attributes to numerical")
+    parser.add_argument("-j", dest="n_jobs"    , default=0    , type=int, help="number of cores to use (default: all)")
+    parser.add_argument("--stages", dest="pipeline_jobs", default=0, type=int, help="number of independent pipeline stages run at the same time (default: 2 if there are 2 or more cores)")
+    parser.add_argument("-k", dest="chunksize" , default=0    , type=int, help="reads train/test files in chunks of CHUNKSIZE rows to bound memory usage")
+    parser.add_argument("--vocabulary", dest="vocabulary", default=None , help="nominal attributes vocabulary file. It is loaded if it exists, otherwise it is fitted on train file and saved")
+    parser.add_argument("--no-cache"  , dest="use_cache" , default=True , action="store_false", help="always run all stages and rebuild train/test files instead of using the feature cache")
+    parser.add_argument("--cache-dir" , dest="cache_dir" , default="../cache", help="directory of the feature cache, the pipeline work files and the incremental training state (default: ../cache)")
+    parser.add_argument("--cache-size", dest="cache_size", default=1024 , type=int, help="size limit in MB of the feature cache, the pipeline work files and the incremental training state are not counted (default: 1024)")
+    parser.add_argument("--profile"   , dest="profile"   , default=None , help="writes wall time, CPU time, memory and rows of each stage to PROFILE (.csv or .json)")
+
+
+###############################################################################
+#                       ADD TRAIN ARGUMENTS FUNCTION
+# Options of the train command only: classifiers and output files.
+###############################################################################
+def add_train_arguments(parser):
+    parser.add_argument("--out-dir"   , dest="out_dir"   , default="../out", help="directory of the output files (default: ../out)")
+    parser.add_argument("-t", dest="tunning"   , default=False, action="store_true", help="tunes classifiers parameters with successive halving")
+    parser.add_argument("--tune-budget", dest="tune_budget", default=0, type=int, help="time budget in seconds for each parameter search with -t (default: no limit)")
+    parser.add_argument("-f", dest="fold_pred" , default="best", choices=["best", "ensemble"], help="predicts test data with the best fold model or with the average of all fold models")
+    parser.add_argument("-c", dest="choose_alg", default=False, action="store_true", help="races the candidate classifiers and runs only the best one")
+    parser.add_argument("--race-budget", dest="race_budget", default=0, type=int, help="time budget in seconds for the classifiers race with -c (default: no limit)")
+    parser.add_argument("--parallel", dest="parallel_mode", default="auto", choices=["auto", "folds", "trees", "split"], help="how cores are shared between folds and forest trees (default: auto)")
+    parser.add_argument("--save-model", dest="save_model", default=None , help="saves each trained model as an artifact in SAVE_MODEL/<algorithm> to be used by the predict command")
+    parser.add_argument("--incremental", dest="incremental", default=False, action="store_true", help="trains Random Forest only on the rows appended to the train file since the last run")
+    parser.add_argument("--window"    , dest="window"    , default=20000, type=int, help="latest train rows used to fit the trees added by --incremental (default: 20000)")
+    parser.add_argument("--add-trees" , dest="add_trees" , default=50   , type=int, help="trees added to each forest by --incremental (default: 50)")
+    parser.add_argument("--max-trees" , dest="max_trees" , default=500  , type=int, help="maximum trees of each forest with --incremental, the oldest are dropped (default: 500)")
+    parser.add_argument("--precision" , dest="precision" , default=None , type=int, help="decimals of the probabilities in the output files (default: all)")
+    parser.add_argument("--output-format", dest="output_format", default="csv", choices=result_writer.output_formats, help="output files format: CSV, gzip CSV or NumPy columns (default: csv)")
+
+
+###############################################################################
+#                       ADD PREDICT ARGUMENTS FUNCTION
+# Options of the predict command:
+#   animal_out.py predict ARTIFACT_DIR INPUT_CSV [-o OUTPUT_CSV] [-b BATCH]
+###############################################################################
+def add_predict_arguments(parser):
+    parser.add_argument("artifact", help="model artifact directory saved with --save-model")
+    parser.add_argument("input"   , help="intake CSV file to score")
+    parser.add_argument("-o", dest="output"   , default="../out/score_result.csv", help="output file, gzip CSV if it ends with .csv.gz and NumPy columns if it ends with .npz (default: ../out/score_result.csv)")
+    parser.add_argument("-b", dest="chunksize", default=50000, type=int, help="rows per batch (default: 50000)")
+    parser.add_argument("-j", dest="n_jobs"   , default=0    , type=int, help="number of cores to use (default: all)")
+    parser.add_argument("-v", dest="verbose"  , default=0    , action="count", help="shows script execution steps")
+    parser.add_argument("--precision", dest="precision", default=None, type=int, help="decimals of the written probabilities (default: all)")
+    parser.add_argument("--profile", dest="profile", default=None, help="writes wall time, CPU time, memory and rows of each stage to PROFILE (.csv or .json)")
+
+
+###############################################################################
+#                       APPLY ARGUMENTS FUNCTION
+# Sets the global options from the arguments of the prepare and train
+# commands. Returns an error message when they do not fit together.
+###############################################################################
+def apply_arguments(args):
     global verbose, nanfill, nominal2numeric, norm_data, run_alg, \
-           choose_alg, tunning_par
+           choose_alg, race_budget, tunning_par, tune_budget, chunksize, fold_prediction, n_jobs, parallel_mode, use_cache, cache_dir, cache_size, \
+           pipeline_jobs, incremental, incremental_window, incremental_trees, incremental_max_trees, \
+           date_features, breed_encoding, token_width, token_min_count, attr_comp, \
+           output_precision, output_format, out_dir
+
+    verbose        = args.verbose
+    nanfill        = args.nanfill 
+    nominal2numeric= args.nom2num
+    norm_data      = args.norm_data
+    date_features  = args.date_features
+    if (date_features == True):
+        attr_comp = attr_comp + [name for name in date_att if name not in attr_comp]
+    breed_encoding = args.breed_encoding
+    token_width    = args.token_width
+    token_min_count= args.token_min_count
+    chunksize      = args.chunksize
+    n_jobs         = args.n_jobs
+    pipeline_jobs  = args.pipeline_jobs
+    use_cache      = args.use_cache
+    cache_dir      = args.cache_dir
+    cache_size     = args.cache_size
+    if args.command == "train":
+        out_dir        = args.out_dir
+        fold_prediction= args.fold_pred
+        parallel_mode  = args.parallel_mode
+        incremental    = args.incremental
+        incremental_window    = args.window
+        incremental_trees     = args.add_trees
+        incremental_max_trees = args.max_trees
+        tunning_par    = args.tunning
+        choose_alg     = args.choose_alg
+        race_budget    = args.race_budget
+        tune_budget    = args.tune_budget
+        output_precision = args.precision
+        output_format  = args.output_format
+    profiler.verbose = verbose
+
+    if os.path.abspath(args.train) == os.path.abspath(args.test):
+        return "Train and test filenames must be unique!"
+    if (norm_data == True and nominal2numeric == False):
+        return "To normalize data nominal values must be converted into numbers with -x"
+    if (breed_encoding != "ordinal" and nominal2numeric == False):
+        return "Breed/Color components encodings need nominal values converted into numbers with -x"
+    if (incremental == True and nominal2numeric == False):
+        return "Incremental training needs nominal values converted into numbers with -x"
+    return None
+
+
+###############################################################################
+#                           NEW RUNNER FUNCTION
+# Pipeline runner of the prepare and train commands. The pipeline is a DAG
+# of stages: independent stages run at the same time and stages whose inputs
+# and parameters did not change since the last run are skipped.
+###############################################################################
+def new_runner():
+    global pipeline_jobs
+
+    if pipeline_jobs <= 0:
+        pipeline_jobs = min(total_cores(), 2)
+    work_dir = os.path.join(cache_dir, "pipeline")
+    runner = pipeline_runner.PipelineRunner(os.path.join(work_dir, "state.json"), \
+                                            pipeline_jobs, profiler, verbose, \
+                                            force=not use_cache)
+    return runner, work_dir
+
 
-    total_time = time.clock()
+# The vocabulary fitted by the pipeline is saved in the given vocabulary file
+def save_vocabulary(runner, vocabulary_filename):
+    if vocabulary_filename and not os.path.isfile(vocabulary_filename) and \
+       "fit_vocabulary" in runner.stages:
+        shutil.copyfile(runner.stages["fit_vocabulary"].outputs[0], vocabulary_filename)
+
+
+###############################################################################
+#                           PREPARE MAIN FUNCTION
+# Rebuilds and pre-processes the train/test files, so a next train run only
+# runs the classifiers.
+###############################################################################
+def prepare_main(args):
+    runner, work_dir = new_runner()
+    add_data_stages(runner, work_dir, args.train, args.test, args.vocabulary)
+    runner.run()
+    save_vocabulary(runner, args.vocabulary)
+    return 0
+
+
+###############################################################################
+#                           TRAIN MAIN FUNCTION
+# Tunes and runs the classifiers, prints their results and writes their
+# output files.
+###############################################################################
+def train_main(args):
+    if (incremental == True):
+        run_incremental(args.train, args.test, args.vocabulary, args.save_model)
+        return 0
+
+    runner, work_dir = new_runner()
+
+    # Handle input files as they have mixed info in the attributes
+    # and pre-process the data
+    train_frame, test_frame = add_data_stages(runner, work_dir, args.train, args.test, \
+                                              args.vocabulary)
+
+    # Choose which algorithms to run
+    algorithms = ["RandomForest", "DecisionTrees"]
+    if (choose_alg == True):
+        race_filename = os.path.join(work_dir, "race.json")
+        runner.add(pipeline_runner.Stage("race", race_stage, [train_frame], [race_filename], \
+                                         {"race_budget"   : race_budget, \
+                                          "race_min_folds": race_min_folds}, \
+                                         pipeline_settings(runner.max_workers)))
+        if runner.outdated(["race"]):
+            import_learners()
+        runner.run(["race"])
+        with open(race_filename) as race_file:
+            algorithms = [json.load(race_file)["algorithm"]]
+
+    # Tune parameters, run classifiers algorithms, print results and
+    # save output files. Stage processes are forked, so learners are
+    # imported once here when any stage will run.
+    add_algorithm_stages(runner, work_dir, algorithms, train_frame, test_frame, \
+                         args.save_model)
+    if runner.outdated():
+        import_learners()
+    runner.run()
+
+    save_vocabulary(runner, args.vocabulary)
+    return 0
+
+
+###############################################################################
+#                           PREDICT MAIN FUNCTION
+###############################################################################
+def predict_main(args):
+    global verbose, chunksize, n_jobs, output_precision
+
+    verbose   = args.verbose
+    chunksize = args.chunksize
+    n_jobs    = args.n_jobs
+    output_precision = args.precision
+    profiler.verbose = verbose
+    return score(args.artifact, args.input, args.output)
+
+
+###############################################################################
+#                               MAIN FUNCTION
+# Commands:
+#   prepare   rebuilds and pre-processes the train/test files
+#   train     runs the classifiers and writes their output files (default)
+#   predict   scores an intake file with a saved model (old name: score)
+#   benchmark runs benchmark.py
+# Heavy libraries are imported only by the commands that need them.
+###############################################################################
+def main(argv=None): # IGNORE:C0111
+    profiler.reset()
+    if argv is None:
+        argv = sys.argv[1:]
 
     try:
+        # Command lines without a command are train ones, as before
+        # commands existed, and score is the old name of predict
+        argv = list(argv)
+        if len(argv) == 0 or (argv[0].startswith("-") and argv[0] not in ["-h", "--help"]):
+            argv = ["train"] + argv
+        elif argv[0] == "score":
+            argv = ["predict"] + argv[1:]
+        if argv[0] == "benchmark":
+            import benchmark
+            return benchmark.main(argv[1:])
+
         # Parser for command line arguments
-        parser = ArgumentParser()
-        parser.add_argument("-m", dest="norm_data" , default=False, action="store_true", help="normalize numeric data")
-        parser.add_argument("-n", dest="nanfill"   , default=False, action="store_true", help="fills NaN values with -1 instead most frequent value")
-        parser.add_argument("-v", dest="verbose"   , default=0    , action="count",      help="shows script execution steps")
-        parser.add_argument("-x", dest="nom2num"   , default=False, action="store_true", help="convert nominal attributes to numerical")
+        parser = ArgumentParser(prog="animal_out.py", description="Shelter animal outcomes")
+        commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+        add_data_arguments(commands.add_parser("prepare", help="rebuilds and pre-processes the train/test files"))
+        train_parser = commands.add_parser("train", help="runs the classifiers and writes their output files (default)")
+        add_data_arguments(train_parser)
+        add_train_arguments(train_parser)
+        add_predict_arguments(commands.add_parser("predict", help="scores an intake file with a saved model artifact (old name: score)"))
+        commands.add_parser("benchmark", help="runs the benchmark suite, see 'benchmark -h'")
 
         # Process arguments
-        args           = parser.parse_args()
-        verbose        = args.verbose
-        train_filename = "../data/train.csv"
-        test_filename  = "../data/test.csv"
-        out_filename   = "../out/result.csv"
-        nanfill        = args.nanfill 
-        nominal2numeric= args.nom2num
-        norm_data      = args.norm_data
-
-        if verbose > 0:
-            print("Verbose mode: ON")
-
-        if (train_filename and test_filename and out_filename) and \
-           (train_filename == test_filename) or (train_filename == out_filename) or \
-           (test_filename == out_filename):
-            print("ERROR: Input and output filenames must be unique!")
-            return 1
-            
-        if (norm_data == True and nominal2numeric == False):
-            print("ERROR: To normalize data nominal values must be converted into numbers with -x")
-            return 1
-        
-        # Handle input files as they have mixed info in the attributes
-        new_train_file = get_new_file(train_filename)
-        new_test_file  = get_new_file(test_filename)
-        
-        # Pre-process the data
-        train_file = pre_process(new_train_file)
-        test_file  = pre_process(new_test_file)
-        
-        
-        # Run classifiers algorithms
-        rf_train_score, rf_id_test, rf_pred_prob = run_random_forest(train_file, test_file)
-        dt_train_score, dt_id_test, dt_pred_prob = run_decision_trees(train_file, test_file)
-        
-        
-        # Print results and save output file
-        print_results("RandomForest",  rf_id_test, rf_pred_prob, rf_train_score, "../out/rf_result.csv")        
-        print_results("DecisionTrees", dt_id_test, dt_pred_prob, dt_train_score, "../out/dt_result.csv")        
+        args = parser.parse_args(argv)
+        if args.command == "predict":
+            result = predict_main(args)
+        else:
+            error = apply_arguments(args)
+            if error is not None:
+                print("ERROR: " + error)
+                return 1
+            if verbose > 0:
+                print("Verbose mode: ON")
+            if args.command == "prepare":
+                result = prepare_main(args)
+            else:
+                result = train_main(args)
+            if verbose > 0:
+                print
+                print("Total execution time: %8.3f seconds" % profiler.elapsed())
 
-        if verbose > 0:
-            print
-            print("Total execution time: %8.3f seconds" % (time.clock() - total_time))
+        if args.profile:
+            profiler.save(args.profile, {"command": argv, "options": preprocess_options()})
 
-        
         # Ends application
-        return 0
+        return result
     
     
     # Handle errors
@@ -0,0 +1,270 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.benchmark -- Benchmark suite of the whole pipeline across data scales
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    python benchmark.py                      # 10k, 100k and 1M rows
+    python benchmark.py -r 1M,10M -k 500000  # bigger scales, files read by chunks
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+import pandas as datafile
+import sklearn
+from argparse import ArgumentParser
+
+import animal_out
+import synth_data
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Real train file whose distributions are copied by the synthetic files
+source_filename = "../data/train.csv"
+
+# Generated files and stored results
+benchmark_dir    = "../benchmarks"
+data_dir         = os.path.join(benchmark_dir, "data")
+results_filename = os.path.join(benchmark_dir, "results.jsonl")
+
+# Test rows per train row, as in the real train/test files
+test_fraction = 0.43
+
+# Stages faster than this are not reported as regressions, as their time is
+# mostly noise
+min_regression_seconds = 0.05
+
+
+###############################################################################
+#                           GIT COMMIT FUNCTION
+# Current commit, with a '+' when tracked files were changed, or None out of
+# a git repository.
+###############################################################################
+def git_commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], \
+                                             stderr=devnull).decode("utf-8").strip()
+            changes = subprocess.check_output(["git", "status", "--porcelain", \
+                                               "--untracked-files=no"], \
+                                              stderr=devnull).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + "+" if changes else commit
+
+
+###############################################################################
+#                           SYNTHETIC FILES FUNCTION
+# Train and test files of a scale. They are generated once and reused by the
+# next runs with the same seed.
+###############################################################################
+def synthetic_files(nbr_rows, seed):
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    nbr_test_rows = max(int(nbr_rows * test_fraction), 1)
+    train_filename = os.path.join(data_dir, "train_%d_%d.csv" % (nbr_rows, seed))
+    test_filename  = os.path.join(data_dir, "test_%d_%d.csv" % (nbr_test_rows, seed))
+    for filename, rows, kind in [(train_filename, nbr_rows, "train"), \
+                                 (test_filename, nbr_test_rows, "test")]:
+        if not os.path.isfile(filename):
+            print("Generating %s..." % filename)
+            # Write to a temporary file so an interrupted run is not reused
+            synth_data.generate_file(source_filename, filename + ".tmp", rows, kind, \
+                                     seed if kind == "train" else seed + 1)
+            os.rename(filename + ".tmp", filename)
+    return train_filename, test_filename, nbr_test_rows
+
+
+###############################################################################
+#                           RUN SCALE FUNCTION
+# Runs the pipeline stages on synthetic files of 'nbr_rows' train rows and
+# returns the benchmark record with the profile of each stage.
+###############################################################################
+def run_scale(nbr_rows, args):
+    train_filename, test_filename, nbr_test_rows = synthetic_files(nbr_rows, args.seed)
+    profiler = animal_out.profiler
+    profiler.reset()
+
+    with profiler.stage("get_new_file", "Rebuilding train/test files...", \
+                        nbr_rows + nbr_test_rows):
+        train_file = animal_out.get_new_file(train_filename)
+        test_file  = animal_out.get_new_file(test_filename)
+
+    with profiler.stage("pre_process", "Pre-processing train/test files...", \
+                        nbr_rows + nbr_test_rows):
+        vocabulary = animal_out.CategoryVocabulary()
+        train_file = animal_out.pre_process(train_file, vocabulary, False)
+        test_file  = animal_out.pre_process(test_file, vocabulary, False)
+
+    try:
+        for algorithm in args.algorithms:
+            prefix = animal_out.algorithm_prefix[algorithm]
+            params = None
+            if args.tunning and algorithm in animal_out.search_spaces:
+                classif = dict(animal_out.candidate_classifiers())[algorithm]
+                with profiler.stage("tunning_parameters_%s" % prefix, rows=nbr_rows):
+                    params = animal_out.tunning_parameters(classif, \
+                                 animal_out.search_spaces[algorithm], train_file)
+            elif algorithm in ["RandomForest", "ExtraTrees"]:
+                params = {"n_estimators": args.trees}
+
+            with profiler.stage("cross_validation_%s" % prefix, rows=nbr_rows):
+                train_score, id_test, pred_prob, _ = \
+                    animal_out.run_algorithm(algorithm, train_file, test_file, params)
+
+            with profiler.stage("print_results_%s" % prefix, rows=nbr_test_rows):
+                animal_out.print_results(algorithm, id_test, pred_prob, train_score, \
+                                         os.path.join(data_dir, "%s_result.csv" % prefix))
+    finally:
+        # Shared train arrays of this scale are not needed by the next one
+        animal_out.remove_shared_arrays()
+
+    return {"commit"    : git_commit(),
+            "date"      : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "rows"      : nbr_rows,
+            "test_rows" : nbr_test_rows,
+            "seed"      : args.seed,
+            "algorithms": args.algorithms,
+            "trees"     : args.trees,
+            "tunning"   : args.tunning,
+            "chunksize" : args.chunksize,
+            "date_features": args.date_features,
+            "breed_encoding": args.breed_encoding,
+            "precision" : args.precision,
+            "cores"     : animal_out.total_cores(),
+            "versions"  : {"python" : platform.python_version(),
+                           "numpy"  : np.__version__,
+                           "pandas" : datafile.__version__,
+                           "sklearn": sklearn.__version__},
+            "total_seconds": profiler.elapsed(),
+            "stages"    : profiler.stages()}
+
+
+###############################################################################
+#                           LOAD RESULTS FUNCTION
+###############################################################################
+def load_results():
+    if not os.path.isfile(results_filename):
+        return []
+    with open(results_filename) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+###############################################################################
+#                           PREVIOUS RESULT FUNCTION
+# Latest stored record of the same benchmark made on another commit.
+###############################################################################
+def previous_result(record, results):
+    same_setup = ["rows", "seed", "algorithms", "trees", "tunning", "chunksize", "cores", \
+                  "date_features", "breed_encoding", "precision"]
+    # Values of settings added after the first stored records
+    defaults = {"date_features": False, "breed_encoding": "ordinal"}
+    for result in reversed(results):
+        if all(result.get(key, defaults.get(key)) == record[key] for key in same_setup) and \
+           (result["commit"] != record["commit"] or record["commit"] is None):
+            return result
+    return None
+
+
+###############################################################################
+#                           PRINT COMPARISON FUNCTION
+# Top level stages of a record against the previous one. Stages slower by
+# more than 'tolerance' are flagged as regressions, and their number is
+# returned.
+###############################################################################
+def print_comparison(record, previous, tolerance):
+    previous_stages = {}
+    if previous is not None:
+        previous_stages = dict((stage["stage"], stage) for stage in previous["stages"])
+        print("%d rows, compared with commit %s of %s" % \
+              (record["rows"], previous["commit"], previous["date"]))
+    else:
+        print("%d rows, no previous result to compare with" % record["rows"])
+
+    nbr_regressions = 0
+    print("%-32s %10s %10s %10s %8s" % ("Stage", "Seconds", "Previous", "Rows/s", "Ratio"))
+    for stage in record["stages"]:
+        if "/" in stage["stage"]:
+            continue
+        rows_per_second = (stage["rows"] or 0) / max(stage["wall_seconds"], 1e-9)
+        line = "%-32s %10.3f" % (stage["stage"], stage["wall_seconds"])
+        old_stage = previous_stages.get(stage["stage"])
+        if old_stage is None:
+            print(line + " %10s %10.0f" % ("-", rows_per_second))
+            continue
+        ratio = stage["wall_seconds"] / max(old_stage["wall_seconds"], 1e-9)
+        line += " %10.3f %10.0f %7.2fx" % (old_stage["wall_seconds"], rows_per_second, ratio)
+        if ratio > 1.0 + tolerance and stage["wall_seconds"] >= min_regression_seconds:
+            line += "  <-- regression"
+            nbr_regressions += 1
+        print(line)
+    print("")
+    return nbr_regressions
+
+
+###############################################################################
+#                               MAIN FUNCTION
+###############################################################################
+def main(argv=None):
+    parser = ArgumentParser(prog="benchmark.py")
+    parser.add_argument("-r", dest="rows"      , default="10k,100k,1M", help="comma separated train rows of each scale (default: 10k,100k,1M)")
+    parser.add_argument("-a", dest="algorithms", default="RandomForest,DecisionTrees", help="comma separated algorithms to cross-validate (default: RandomForest,DecisionTrees)")
+    parser.add_argument("-n", dest="trees"     , default=50, type=int, help="trees of forest algorithms when not tuned (default: 50)")
+    parser.add_argument("-t", dest="tunning"   , default=False, action="store_true", help="also benchmarks successive halving tuning")
+    parser.add_argument("--tune-budget", dest="tune_budget", default=60, type=int, help="time budget in seconds of each tuning (default: 60)")
+    parser.add_argument("-d", dest="date_features", default=False, action="store_true", help="also derives hour, weekday, month, year and days since epoch from DateTime")
+    parser.add_argument("--breed-encoding", dest="breed_encoding", default="ordinal", choices=["ordinal", "hashed", "frequency"], help="Breed/Color encoding (default: ordinal)")
+    parser.add_argument("--precision", dest="precision", default=None, type=int, help="decimals of the written probabilities (default: all)")
+    parser.add_argument("-k", dest="chunksize" , default=0, type=int, help="reads files in chunks of CHUNKSIZE rows")
+    parser.add_argument("-j", dest="n_jobs"    , default=0, type=int, help="number of cores to use (default: all)")
+    parser.add_argument("--seed", dest="seed"  , default=1000, type=int, help="random seed of the synthetic files (default: 1000)")
+    parser.add_argument("--tolerance", dest="tolerance", default=0.2, type=float, help="slowdown flagged as a regression (default: 0.2, i.e. 20%%)")
+    parser.add_argument("--no-save", dest="save", default=True, action="store_false", help="does not store the results in %s" % results_filename)
+    args = parser.parse_args(argv)
+    args.algorithms = args.algorithms.split(",")
+    for algorithm in args.algorithms:
+        if algorithm not in animal_out.algorithm_prefix:
+            parser.error("unknown algorithm %s" % algorithm)
+
+    animal_out.import_learners()
+    animal_out.nominal2numeric = True
+    animal_out.chunksize   = args.chunksize
+    animal_out.n_jobs      = args.n_jobs
+    animal_out.tune_budget = args.tune_budget
+    animal_out.breed_encoding = args.breed_encoding
+    animal_out.output_precision = args.precision
+    if args.date_features:
+        animal_out.date_features = True
+        animal_out.attr_comp = animal_out.attr_comp + animal_out.date_att
+
+    results = load_results()
+    nbr_regressions = 0
+    for nbr_rows in [synth_data.parse_rows(rows) for rows in args.rows.split(",")]:
+        record = run_scale(nbr_rows, args)
+        print("")
+        nbr_regressions += print_comparison(record, previous_result(record, results), \
+                                            args.tolerance)
+        results.append(record)
+        if args.save:
+            with open(results_filename, "a") as results_file:
+                results_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+    return 1 if nbr_regressions > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
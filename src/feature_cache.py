@@ -0,0 +1,161 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.feature_cache -- On-disk cache for the rebuilt train/test frames
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import lazy_module
+
+datafile = lazy_module.LazyModule("pandas")
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Bump it every time the cache layout changes
+cache_layout_version = 2
+
+# Block size used to hash input files
+hash_block_size = 1 << 20
+
+# Default cache size limit in bytes
+default_max_size = 1024 << 20
+
+
+###############################################################################
+#                           FEATURE CACHE CLASS
+# Each entry is a directory named by a hash of the input file bytes and of
+# the preprocessing options. Every column is stored in its own .npy file so
+# it can be loaded back memory-mapped. Nominal columns are stored as integer
+# codes plus a small table of distinct values and loaded back as categoricals
+# on the memory-mapped codes, so loading an entry copies no column. The least
+# recently used entries are evicted when the cache grows beyond max_size
+# bytes.
+###############################################################################
+class FeatureCache(object):
+
+    def __init__(self, cache_dir, max_size=default_max_size):
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+
+
+    # Builds the key of an entry from the input files and options
+    def key(self, filenames, options):
+        digest = hashlib.sha1()
+        digest.update(("layout=%d\n" % cache_layout_version).encode("utf-8"))
+        for filename in filenames:
+            with open(filename, "rb") as input_file:
+                block = input_file.read(hash_block_size)
+                while block:
+                    digest.update(block)
+                    block = input_file.read(hash_block_size)
+        digest.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+
+    # Returns (frame, extra) for a cached entry or None if it is not cached
+    def load(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_filename = os.path.join(entry_dir, "meta.json")
+        if not os.path.isfile(meta_filename):
+            return None
+        with open(meta_filename) as meta_file:
+            meta = json.load(meta_file)
+
+        columns = {}
+        for i, column in enumerate(meta["columns"]):
+            # Plain array views of the mapped files, so derived arrays are not
+            # memmap objects
+            values = np.load(os.path.join(entry_dir, "%03d.npy" % i), mmap_mode="r")\
+                       .view(np.ndarray)
+            if column["nominal"]:
+                uniques = np.load(os.path.join(entry_dir, "%03d_uniques.npy" % i), \
+                                  allow_pickle=True)
+                # NaN values have code -1, which categoricals read as NaN
+                values = datafile.Categorical.from_codes(values, uniques, validate=False)
+            columns[column["name"]] = values
+        index = np.load(os.path.join(entry_dir, "index.npy"), mmap_mode="r").view(np.ndarray)
+        frame = datafile.DataFrame(columns, index=index, copy=False, \
+                                   columns=[column["name"] for column in meta["columns"]])
+
+        # Mark the entry as recently used
+        os.utime(meta_filename, None)
+        return frame, meta["extra"]
+
+
+    # Stores a frame and some extra json data under the given key
+    def store(self, key, frame, extra=None):
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir   = "%s.tmp-%d" % (entry_dir, os.getpid())
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        meta = {"columns": [], "extra": extra}
+        for i, name in enumerate(frame.columns):
+            values  = np.asarray(frame[name].values)
+            nominal = values.dtype.kind == "O"
+            if nominal:
+                codes, uniques = datafile.factorize(values)
+                np.save(os.path.join(tmp_dir, "%03d_uniques.npy" % i), \
+                        np.asarray(uniques, dtype=object), allow_pickle=True)
+                values = codes.astype(code_dtype(len(uniques)))
+            np.save(os.path.join(tmp_dir, "%03d.npy" % i), values)
+            meta["columns"].append({"name": name, "nominal": bool(nominal)})
+        np.save(os.path.join(tmp_dir, "index.npy"), frame.index.values)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file)
+
+        # Publish the entry at once. Another process may have stored it first.
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+        self.evict(keep=key)
+
+
+    # Removes least recently used entries until the cache fits in max_size
+    def evict(self, keep=None):
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            meta_filename = os.path.join(entry_dir, "meta.json")
+            if not os.path.isfile(meta_filename):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, name)) \
+                       for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(meta_filename), key, size))
+            total_size += size
+
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total_size -= size
+
+
+###############################################################################
+#                           CODE DTYPE FUNCTION
+# Integer type of the codes of 'nbr_values' distinct values, the one pandas
+# categoricals use, so they are loaded without converting them.
+###############################################################################
+def code_dtype(nbr_values):
+    for dtype in (np.int8, np.int16, np.int32):
+        if nbr_values < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
@@ -0,0 +1,173 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.forest_inference -- Array based inference for tree classifiers
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+'''
+
+import sys
+import time
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Number of (row, tree) pairs traversed at once by each block
+block_cells = 1 << 20
+
+
+###############################################################################
+#                           IS SUPPORTED FUNCTION
+# Only classifiers made of plain decision trees can be compiled.
+###############################################################################
+def is_supported(classif):
+    if hasattr(classif, "tree_"):
+        return True
+    trees = getattr(classif, "estimators_", [])
+    return len(trees) > 0 and all(hasattr(tree, "tree_") for tree in trees)
+
+
+###############################################################################
+#                           FLAT FOREST CLASS
+# Compiles a fitted RandomForestClassifier, ExtraTreesClassifier or
+# DecisionTreeClassifier into contiguous node arrays shared by all trees:
+# feature, threshold, left/right child and the class distribution of each
+# node. A block of rows goes down all trees at once with vectorized steps
+# until every row has reached a leaf in every tree.
+# Results match predict_proba of the original classifier. It is much faster
+# for small batches, where the per tree overhead of predict_proba dominates,
+# but slower than the compiled traversal of predict_proba for big batches.
+###############################################################################
+class FlatForest(object):
+
+    def __init__(self, classif):
+        trees = getattr(classif, "estimators_", [classif])
+        self.classes_ = classif.classes_
+        nbr_nodes = [tree.tree_.node_count for tree in trees]
+        self.roots = np.cumsum([0] + nbr_nodes[:-1]).astype(np.intp)
+
+        features, thresholds, lefts, rights, values = [], [], [], [], []
+        for root, tree in zip(self.roots, trees):
+            tree = tree.tree_
+            nodes = np.arange(tree.node_count, dtype=np.intp)
+            is_leaf = tree.children_left < 0
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            lefts.append(root + np.where(is_leaf, nodes, tree.children_left))
+            rights.append(root + np.where(is_leaf, nodes, tree.children_right))
+            # Class distribution of each node, as in tree predict_proba
+            value = tree.value[:, 0, :]
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            values.append(value / normalizer)
+
+        self.feature   = np.ascontiguousarray(np.concatenate(features), dtype=np.intp)
+        self.threshold = np.ascontiguousarray(np.concatenate(thresholds), dtype=np.float64)
+        self.left      = np.ascontiguousarray(np.concatenate(lefts), dtype=np.intp)
+        self.right     = np.ascontiguousarray(np.concatenate(rights), dtype=np.intp)
+        self.value     = np.ascontiguousarray(np.concatenate(values), dtype=np.float64)
+        self.is_leaf   = self.left == np.arange(len(self.left))
+
+
+    # Class probabilities of X, averaged over all trees. Row blocks may be
+    # spread across 'n_threads' threads.
+    def predict_proba(self, X, n_threads=1):
+        # Trees compare float32 features against float64 thresholds
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        block_rows = max(block_cells // len(self.roots), 1)
+        blocks = [X[start:start + block_rows] for start in range(0, len(X), block_rows)]
+        if n_threads > 1 and len(blocks) > 1:
+            pool = ThreadPool(n_threads)
+            try:
+                results = pool.map(self.predict_block, blocks)
+            finally:
+                pool.close()
+        else:
+            results = [self.predict_block(block) for block in blocks]
+        if len(results) == 0:
+            return np.zeros((0, len(self.classes_)))
+        return np.concatenate(results)
+
+
+    # Each (row, tree) pair is a cell. Only the cells not yet on a leaf are
+    # moved down at each step, so the work follows the real path lengths
+    # and not the depth of the deepest tree.
+    def predict_block(self, X):
+        nbr_rows, nbr_features = X.shape
+        nbr_trees = len(self.roots)
+        features = X.ravel()
+        node = np.tile(self.roots, nbr_rows)
+        row_start = np.repeat(np.arange(nbr_rows, dtype=np.intp) * nbr_features, nbr_trees)
+        active = np.flatnonzero(~self.is_leaf[node])
+        while len(active) > 0:
+            current = node[active]
+            go_left = features[row_start[active] + self.feature[current]] <= \
+                      self.threshold[current]
+            current = np.where(go_left, self.left[current], self.right[current])
+            node[active] = current
+            active = active[~self.is_leaf[current]]
+        return self.value[node].reshape(nbr_rows, nbr_trees, -1).mean(axis=1)
+
+
+    def predict(self, X, n_threads=1):
+        return self.classes_.take(np.argmax(self.predict_proba(X, n_threads), axis=1))
+
+
+###############################################################################
+#                           BENCHMARK FUNCTION
+# Compares predict_proba throughput of a forest and of its FlatForest on
+# random data with shelter like attributes. The forest is always fitted on
+# 20000 rows and then scores batches of 'batch_rows' rows.
+###############################################################################
+def benchmark(batch_rows=100000, nbr_trees=100, n_threads=1):
+    from sklearn.ensemble import RandomForestClassifier
+
+    random_state = np.random.RandomState(1000)
+    nbr_rows = max(batch_rows, 20000)
+    cardinality = [60, 220, 2, 3, 3, 2, 2, 3, 50]
+    X = np.column_stack([random_state.randint(0, c, nbr_rows) for c in cardinality])
+    y = (X[:, 0] + 3 * X[:, 4] + random_state.randint(0, 20, nbr_rows)) % 5
+    classif = RandomForestClassifier(n_estimators=nbr_trees, max_features="sqrt", \
+                                     random_state=1000, n_jobs=n_threads)
+    classif.fit(X[:20000], y[:20000])
+    X = X[:batch_rows]
+
+    start_time = time.time()
+    flat_forest = FlatForest(classif)
+    compile_time = time.time() - start_time
+
+    forest_speed = rows_per_second(lambda: classif.predict_proba(X), batch_rows)
+    flat_speed = rows_per_second(lambda: flat_forest.predict_proba(X, n_threads), batch_rows)
+    difference = np.abs(flat_forest.predict_proba(X) - classif.predict_proba(X)).max()
+
+    print("%d rows per batch, %d trees, %d threads" % (batch_rows, nbr_trees, n_threads))
+    print("forest predict_proba : %10.0f rows/s" % forest_speed)
+    print("flat forest          : %10.0f rows/s (compiled in %.3f seconds)" % \
+          (flat_speed, compile_time))
+    print("max difference       : %g" % difference)
+
+
+###############################################################################
+#                           ROWS PER SECOND FUNCTION
+# Runs 'predict' for at least half a second and returns its throughput.
+###############################################################################
+def rows_per_second(predict, batch_rows):
+    nbr_batches = 0
+    start_time = time.time()
+    while nbr_batches == 0 or time.time() - start_time < 0.5:
+        predict()
+        nbr_batches += 1
+    return nbr_batches * batch_rows / (time.time() - start_time)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    benchmark(*args)
@@ -0,0 +1,34 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.lazy_module -- Modules imported when they are first used
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    datafile = LazyModule("pandas")     # instead of: import pandas as datafile
+'''
+
+import importlib
+
+
+###############################################################################
+#                           LAZY MODULE CLASS
+# Stands for a module which is imported the first time one of its attributes
+# is used. Commands that never use it, like --help, do not pay its import.
+###############################################################################
+class LazyModule(object):
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
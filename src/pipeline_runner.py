@@ -0,0 +1,292 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.pipeline_runner -- Runs a DAG of stages concurrently and incrementally
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+'''
+
+import os
+import sys
+import json
+import hashlib
+import traceback
+import multiprocessing
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Bump it every time the state file layout changes
+state_version = 1
+
+# Block size used to hash input files
+hash_block_size = 1 << 20
+
+# Stages run in forked processes where possible, so they get the modules and
+# settings already loaded by the main process
+try:
+    process_context = multiprocessing.get_context("fork")
+except (AttributeError, ValueError):
+    process_context = multiprocessing
+
+
+###############################################################################
+#                               STAGE CLASS
+# One step of a pipeline. 'func' is a module level function called with the
+# stage itself, so it finds its input and output files and its parameters.
+# 'params' are part of the stage signature: changing them runs the stage
+# again. 'settings' are passed along but do not change the stage results
+# (number of cores, verbosity...).
+###############################################################################
+class Stage(object):
+
+    def __init__(self, name, func, inputs, outputs, params=None, settings=None):
+        self.name     = name
+        self.func     = func
+        self.inputs   = list(inputs)
+        self.outputs  = list(outputs)
+        self.params   = params if params is not None else {}
+        self.settings = settings if settings is not None else {}
+
+
+###############################################################################
+#                           PIPELINE RUNNER CLASS
+# Stages depend on the stages producing their input files. Ready stages run
+# at the same time, up to 'max_workers' processes. Each one runs in its own
+# process, which is not a daemon, so stages may still use parallel workers.
+# A stage is skipped when its outputs exist and its signature (function,
+# parameters and hash of its input files) is the one of its last successful
+# run, as kept in 'state_filename'. File hashes are cached in the state by
+# file size and modification time. With 'force' all stages run.
+# Each stage is profiled with 'profiler', and the profile recorded by the
+# stage process is merged back under the stage name.
+###############################################################################
+class PipelineRunner(object):
+
+    def __init__(self, state_filename, max_workers=1, profiler=None, verbose=0, force=False):
+        self.state_filename = state_filename
+        self.max_workers = max(max_workers, 1)
+        self.profiler = profiler
+        self.verbose = verbose
+        self.force = force
+        self.stages = {}
+        self.order = []
+        self.state = {"version": state_version, "stages": {}, "hashes": {}}
+        if os.path.isfile(state_filename):
+            with open(state_filename) as state_file:
+                state = json.load(state_file)
+            if state.get("version") == state_version:
+                self.state = state
+
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError("Stage %s already exists" % stage.name)
+        self.stages[stage.name] = stage
+        self.order.append(stage.name)
+        return stage
+
+
+    # Names of the stages producing the inputs of a stage
+    def dependencies(self, name):
+        producers = dict((os.path.abspath(output), producer) for producer in self.order \
+                         for output in self.stages[producer].outputs)
+        return set(producers[os.path.abspath(filename)] for filename in self.stages[name].inputs \
+                   if os.path.abspath(filename) in producers)
+
+
+    # Names of the given stages and of the stages they depend on, or of all
+    # of them
+    def selected(self, targets=None):
+        needed = list(self.order if targets is None else targets)
+        selected = set()
+        while needed:
+            name = needed.pop()
+            if name not in selected:
+                selected.add(name)
+                needed.extend(self.dependencies(name))
+        return selected
+
+
+    # Names of the stages found out of date before run(targets). It is empty
+    # only when run(targets) skips all stages.
+    def outdated(self, targets=None):
+        selected = self.selected(targets)
+        return [name for name in self.order if name in selected and \
+                not self.is_up_to_date(self.stages[name], self.signature(self.stages[name]))]
+
+
+    # Runs the given stages and the stages they depend on, or all of them.
+    # Returns the names of the stages that ran and of the skipped ones.
+    def run(self, targets=None):
+        selected = self.selected(targets)
+        waiting = dict((name, self.dependencies(name)) for name in self.order \
+                       if name in selected)
+
+        ran, skipped, failures, running = [], [], [], {}
+        queue = process_context.Queue()
+        while running or (waiting and not failures):
+            # Start the stages whose dependencies are done
+            ready = [name for name in self.order if name in waiting and not waiting[name]]
+            if not ready and not running:
+                raise ValueError("Stages %s depend on each other" % ", ".join(sorted(waiting)))
+            for name in ready:
+                if len(running) >= self.max_workers or failures:
+                    break
+                del waiting[name]
+                stage = self.stages[name]
+                signature = self.signature(stage)
+                if self.is_up_to_date(stage, signature):
+                    if self.verbose > 0:
+                        print("Stage %s is up to date" % name)
+                    skipped.append(name)
+                    self.done(name, waiting)
+                    continue
+                if self.verbose > 0:
+                    print("Stage %s started" % name)
+                for directory in set(os.path.dirname(output) for output in stage.outputs):
+                    if directory and not os.path.isdir(directory):
+                        os.makedirs(directory)
+                if self.max_workers == 1:
+                    # Nothing runs at the same time, so it runs in this process
+                    running[name] = (None, signature)
+                    self.finish(run_stage(stage, self.profiler, None), running, waiting, \
+                                ran, failures)
+                else:
+                    process = process_context.Process(target=run_stage, \
+                                                      args=(stage, self.profiler, queue))
+                    process.start()
+                    running[name] = (process, signature)
+
+            # Wait for a stage to end
+            if any(process is not None for process, _ in running.values()):
+                self.finish(self.wait_result(queue, running), running, waiting, ran, failures)
+
+        if failures:
+            raise RuntimeError("Stage %s failed:\n%s" % failures[0])
+        return ran, skipped
+
+
+    # Next stage result. A stage process that died without sending its
+    # result, like one killed by the system, is a failed stage.
+    def wait_result(self, queue, running):
+        while True:
+            try:
+                return queue.get(timeout=1.0)
+            except Empty:
+                for name, (process, _) in running.items():
+                    if process is not None and process.exitcode not in [None, 0]:
+                        return (name, False, "Stage process ended with exit code %d" % \
+                                process.exitcode, [])
+
+
+    # Handles the end of a stage
+    def finish(self, result, running, waiting, ran, failures):
+        name, succeeded, error, entries = result
+        process, signature = running.pop(name)
+        if process is not None:
+            process.join()
+            # Profile recorded by the stage process, under the current stage
+            if self.profiler is not None:
+                for entry in entries:
+                    self.profiler.add("/".join(self.profiler.stack + [entry["stage"]]), \
+                                      entry["wall_seconds"], entry["cpu_seconds"], \
+                                      entry["peak_rss_mb"], entry["rss_growth_mb"], \
+                                      entry["rows"], entry["calls"])
+        if not succeeded:
+            failures.append((name, error))
+            return
+        if self.verbose > 0:
+            print("Stage %s finished" % name)
+        self.state["stages"][name] = signature
+        self.save_state()
+        ran.append(name)
+        self.done(name, waiting)
+
+
+    # Removes a finished stage from the dependencies of the waiting ones
+    def done(self, name, waiting):
+        for dependencies in waiting.values():
+            dependencies.discard(name)
+
+
+    def is_up_to_date(self, stage, signature):
+        return not self.force and self.state["stages"].get(stage.name) == signature and \
+               all(os.path.exists(output) for output in stage.outputs)
+
+
+    # Hash of the function, parameters and input files of a stage
+    def signature(self, stage):
+        digest = hashlib.sha1()
+        digest.update(("%s.%s\n" % (stage.func.__module__, stage.func.__name__)).encode("utf-8"))
+        digest.update(json.dumps(stage.params, sort_keys=True).encode("utf-8"))
+        for filename in stage.inputs:
+            digest.update(("\n%s=%s" % (os.path.basename(filename), \
+                                        self.file_hash(filename))).encode("utf-8"))
+        return digest.hexdigest()
+
+
+    # Hash of a file contents, cached by its size and modification time
+    def file_hash(self, filename):
+        if not os.path.isfile(filename):
+            return None
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        cached = self.state["hashes"].get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime]:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, "rb") as input_file:
+            block = input_file.read(hash_block_size)
+            while block:
+                digest.update(block)
+                block = input_file.read(hash_block_size)
+        self.state["hashes"][path] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+        return digest.hexdigest()
+
+
+    def save_state(self):
+        directory = os.path.dirname(self.state_filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_filename = "%s.tmp-%d" % (self.state_filename, os.getpid())
+        with open(tmp_filename, "w") as state_file:
+            json.dump(self.state, state_file, indent=1, sort_keys=True)
+        if os.path.exists(self.state_filename):
+            os.remove(self.state_filename)
+        os.rename(tmp_filename, self.state_filename)
+
+
+###############################################################################
+#                           RUN STAGE FUNCTION
+# Runs a stage and returns (name, succeeded, error, profile entries), or puts
+# it in 'queue' when the stage runs in its own process.
+###############################################################################
+def run_stage(stage, profiler, queue):
+    entries, error = [], None
+    if queue is not None and profiler is not None:
+        profiler.reset()
+    try:
+        if profiler is not None:
+            with profiler.stage(stage.name):
+                stage.func(stage)
+            entries = profiler.stages()
+        else:
+            stage.func(stage)
+    except Exception:
+        error = traceback.format_exc()
+    result = (stage.name, error is None, error, entries)
+    if queue is None:
+        return result
+    sys.stdout.flush()
+    queue.put(result)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+'''
+src.predict_server -- Local prediction server for single animal lookups
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    python3 predict_server.py ARTIFACT_DIR [--host 127.0.0.1] [--port 8080]
+
+    POST /predict  {"AnimalType": "Dog", "SexuponOutcome": "Neutered Male",
+                    "AgeuponOutcome": "1 year", "Breed": "Shetland Sheepdog Mix",
+                    "Color": "Brown/White", "Name": "Hambone"}
+    GET  /stats    request count, batches and p50/p99 latency in milliseconds
+'''
+
+import sys
+import json
+import time
+import asyncio
+import collections
+import http.client
+import numpy as np
+from argparse           import ArgumentParser
+from functools          import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+
+import animal_out
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Number of latest requests used for latency percentiles
+latency_window = 10000
+
+# Values remembered by each memoized derivation. Requests carry values sent
+# by clients, so the memory of a long running server must not grow with them.
+memo_size = 4096
+
+# Derivations computed for each request: their values, like names, are
+# nearly unique and cheap to derive
+unmemoized_att = ["hasName"]
+
+# Raw attributes every request must have
+required_att = ["AnimalType", "Breed", "Color"]
+
+# Raw attribute and derivation of each feature
+derivations = {"AnimalType"     : ("AnimalType",     lambda x: x),
+               "DaysUponOutcome": ("AgeuponOutcome", animal_out.age_in_days),
+               "Sex"            : ("SexuponOutcome", animal_out.get_sex),
+               "Neutered"       : ("SexuponOutcome", animal_out.get_neutered),
+               "isMix"          : ("Breed",          animal_out.get_is_mix),
+               "singleBreed"    : ("Breed",          animal_out.get_single_breed),
+               "singleColor"    : ("Color",          animal_out.get_single_color),
+               "nbrofColors"    : ("Color",          animal_out.get_nbr_of_colors),
+               "hasName"        : ("Name",           animal_out.get_has_name)}
+
+
+# DateTime features of one value. It is parsed once for all of them.
+@lru_cache(maxsize=memo_size)
+def parse_date(x):
+    return animal_out.date_table(np.array([x], dtype=object))
+
+
+def date_feature(name, x):
+    return parse_date(x)[name][0]
+
+
+for name in animal_out.date_att:
+    derivations[name] = ("DateTime", partial(date_feature, name))
+
+
+###############################################################################
+#                       PREDICTION SERVER CLASS
+# Loads a model artifact once and answers predictions over HTTP. Features of
+# each request are derived with memoized functions, as the same breeds,
+# colors and ages show up again and again. Memoized values are bounded by
+# memo_size, the least recently used ones are forgotten. Requests arriving together are
+# grouped in micro-batches of up to max_batch rows, waiting at most
+# max_delay seconds, and each micro-batch is predicted with one call.
+# Missing attributes are not filled with the most frequent value of a file,
+# they get the value the derivation functions give to NaN.
+###############################################################################
+class PredictionServer(object):
+
+    def __init__(self, artifact_dir, max_batch=64, max_delay=0.002):
+        self.config, self.vocabulary, self.fold_models = \
+            animal_out.load_model_artifact(artifact_dir)
+        if not self.config["options"]["nominal2numeric"]:
+            raise ValueError("Model artifact must be trained with -x")
+        self.fold_models.compile()
+        self.outcomes = self.vocabulary.categories["OutcomeType"]
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.executor = ThreadPoolExecutor(1)
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.nbr_requests = 0
+        self.nbr_batches = 0
+        self.derive = dict((name, func if name in unmemoized_att else \
+                                  lru_cache(maxsize=memo_size)(func)) \
+                           for name, (_, func) in derivations.items())
+        self.encode = lru_cache(maxsize=memo_size)(self.encode_value)
+        self.tokens = lru_cache(maxsize=memo_size)(self.token_values)
+
+
+    # Code of a nominal value in the artifact vocabulary
+    def encode_value(self, column, value):
+        return int(self.vocabulary.encode(column, np.array([value], dtype=object))[0])
+
+
+    # Token columns of one Breed/Color pair, with a components encoding
+    def token_values(self, breed, color):
+        return animal_out.encode_tokens({"Breed": [breed], "Color": [color]}, \
+                                        self.vocabulary).toarray()[0].tolist()
+
+
+    # Feature row of one animal, in the artifact attribute order
+    def features(self, record):
+        for column in required_att:
+            if record.get(column) is None:
+                raise ValueError("%s is required" % column)
+        missing = -1 if self.config["options"]["nanfill"] else np.nan
+        row = []
+        for name in self.config["attr_comp"]:
+            raw_value = record.get(derivations[name][0])
+            value = self.derive[name](missing if raw_value is None else raw_value)
+            if name in self.vocabulary.categories:
+                value = self.encode(name, value)
+            row.append(float(value))
+        if animal_out.breed_encoding != "ordinal":
+            row += self.tokens(record.get("Breed"), record.get("Color"))
+        return row
+
+
+    async def predict(self, record):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((self.features(record), future))
+        return await future
+
+
+    # Groups queued requests in micro-batches and predicts each one at once
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.empty() and self.max_delay > 0:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            rows = np.array([row for row, _ in batch])
+            try:
+                pred_prob = await loop.run_in_executor(
+                    self.executor, self.fold_models.predict_proba, rows, \
+                    self.config["fold_prediction"])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.nbr_batches += 1
+            for (_, future), prob in zip(batch, pred_prob):
+                future.set_result(dict(zip(self.outcomes, prob.tolist())))
+
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000.0
+        return {"requests"      : self.nbr_requests,
+                "batches"       : self.nbr_batches,
+                "p50_latency_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_latency_ms": float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+
+    # Serves the HTTP/1.1 requests of one connection
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                start_time = time.time()
+                method, path = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, answer = 200, None
+                if method == "POST" and path == "/predict":
+                    try:
+                        answer = await self.predict(json.loads(body.decode("utf-8")))
+                        self.nbr_requests += 1
+                        self.latencies.append(time.time() - start_time)
+                    except (ValueError, TypeError, AttributeError, KeyError) as e:
+                        status, answer = 400, {"error": str(e)}
+                elif method == "GET" and path == "/stats":
+                    answer = self.stats()
+                elif method == "GET" and path == "/health":
+                    answer = {"status": "ok"}
+                else:
+                    status, answer = 404, {"error": "not found"}
+
+                payload = json.dumps(answer).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                              "Content-Length: %d\r\nConnection: %s\r\n\r\n" % \
+                              (status, http.client.responses[status], len(payload), \
+                               "keep-alive" if keep_alive else "close")).encode("latin-1"))
+                writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving %s model on http://%s:%d" % (self.config["algorithm"], host, port))
+        try:
+            await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+###############################################################################
+#                       REQUEST PREDICTION FUNCTION
+# Local client: returns the outcome probabilities of one animal.
+###############################################################################
+def request_prediction(record, host="127.0.0.1", port=8080):
+    connection = http.client.HTTPConnection(host, port)
+    try:
+        connection.request("POST", "/predict", json.dumps(record), \
+                           {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        answer = json.loads(response.read().decode("utf-8"))
+        if response.status != 200:
+            raise ValueError(answer["error"])
+        return answer
+    finally:
+        connection.close()
+
+
+###############################################################################
+#                               MAIN FUNCTION
+###############################################################################
+def main(argv=None):
+    parser = ArgumentParser(prog="predict_server.py")
+    parser.add_argument("artifact", help="model artifact directory saved with --save-model")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", default=8080, type=int, help="port to listen on (default: 8080)")
+    parser.add_argument("--max-batch", dest="max_batch", default=64, type=int, help="maximum requests per micro-batch (default: 64)")
+    parser.add_argument("--max-delay", dest="max_delay", default=2.0, type=float, help="maximum wait in milliseconds to fill a micro-batch (default: 2)")
+    parser.add_argument("-v", dest="verbose", default=0, action="count", help="shows script execution steps")
+    args = parser.parse_args(argv)
+    animal_out.verbose = args.verbose
+
+    server = PredictionServer(args.artifact, args.max_batch, args.max_delay / 1000.0)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.result_writer -- Streaming writer of submission files
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    with ResultWriter("../out/rf_result.csv.gz", precision=6) as writer:
+        for id_block, prob_block in blocks:
+            writer.write(id_block, prob_block)
+'''
+
+import os
+import gzip
+import numpy as np
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Columns of a submission file: the ID and the probability of each outcome
+output_columns = ["ID", "Adoption", "Died", "Euthanasia", "Return_to_owner", "Transfer"]
+
+# Output formats, found from the file name
+output_formats = ["csv", "csv.gz", "npz"]
+
+# Rows formatted at a time, and by each parallel worker
+block_rows = 100000
+
+# Compression level of gzip files: 1 is the fastest, 9 the smallest
+gzip_level = 1
+
+
+###############################################################################
+#                           OUTPUT FORMAT FUNCTION
+# Format of a file from its name: gzip CSV (.csv.gz), NumPy columns (.npz)
+# or CSV otherwise.
+###############################################################################
+def output_format(filename):
+    if filename.endswith(".csv.gz"):
+        return "csv.gz"
+    if filename.endswith(".npz"):
+        return "npz"
+    return "csv"
+
+
+###############################################################################
+#                           FORMAT BLOCK FUNCTION
+# CSV lines of a block of rows, as bytes. Without 'precision' floats are
+# written as pandas to_csv does (shortest repr), so files are the same as
+# before. With 'precision' and integer ids, lines are built at once as a
+# byte array: values are rounded to integers of 'precision' digits as '%.Nf'
+# does (see round_values), split in digits and the padding before each id is
+# removed.
+###############################################################################
+def format_block(ids, pred_prob, precision=None):
+    ids = np.asarray(ids)
+    if len(ids) == 0:
+        return b""
+    if precision is not None and ids.dtype.kind in "iu" and ids.min() >= 0 and \
+       pred_prob.min() >= 0.0 and pred_prob.max() <= 1.0:
+        return fixed_block(ids, pred_prob, precision)
+
+    value_format = "%r" if precision is None else "%%.%df" % precision
+    line_format = ",".join(["%s"] + [value_format] * pred_prob.shape[1])
+    lines = map(line_format.__mod__, zip(ids.tolist(), *pred_prob.T.tolist()))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def fixed_block(ids, pred_prob, precision):
+    nbr_rows, nbr_values = pred_prob.shape
+    id_width = len(str(int(ids.max())))
+    # Each value is one integer digit, the point, 'precision' digits and a
+    # separator
+    value_width = 2 + precision + (1 if precision > 0 else 0)
+    lines = np.empty((nbr_rows, id_width + 1 + nbr_values * value_width), dtype=np.uint8)
+
+    id_digits = digits(ids, id_width)
+    # Leading zeros of ids are padding, except the last digit
+    id_digits[:, :-1][np.cumprod(id_digits[:, :-1] == ord("0"), axis=1) == 1] = 0
+    lines[:, :id_width] = id_digits
+    lines[:, id_width] = ord(",")
+
+    values = round_values(pred_prob, precision)
+    for i in range(nbr_values):
+        start = id_width + 1 + i * value_width
+        value_digits = digits(values[:, i], precision + 1)
+        lines[:, start] = value_digits[:, 0]
+        if precision > 0:
+            lines[:, start + 1] = ord(".")
+            lines[:, start + 2:start + 2 + precision] = value_digits[:, 1:]
+        lines[:, start + value_width - 1] = ord(",")
+    lines[:, -1] = ord("\n")
+
+    lines = lines.ravel()
+    return lines[lines != 0].tobytes()
+
+
+###############################################################################
+#                           ROUND VALUES FUNCTION
+# Values times 10**precision rounded to integers the same way '%.Nf' rounds
+# them. '%.Nf' rounds the exact binary value of each float, while the scaled
+# product has a rounding error of half an ulp and np.rint breaks ties to even,
+# so cells whose scaled value is that close to a tie are rounded by '%.Nf'
+# itself. They are a few cells, unless values are fractions like k/8.
+###############################################################################
+def round_values(pred_prob, precision):
+    scaled = np.asarray(pred_prob, dtype=np.float64) * 10 ** precision
+    values = np.rint(scaled).astype(np.int64)
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 2 * np.abs(np.spacing(scaled))
+    if near_tie.any():
+        value_format = "%%.%df" % precision
+        values[near_tie] = [int((value_format % value).replace(".", ""))
+                            for value in np.asarray(pred_prob)[near_tie].tolist()]
+    return values
+
+
+# ASCII digits of non negative integers, 'width' digits with leading zeros
+def digits(values, width):
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return ((values.astype(np.int64)[:, None] // powers) % 10 + ord("0")).astype(np.uint8)
+
+
+###############################################################################
+#                           RESULT WRITER CLASS
+# Writes the predictions of a submission file block by block, straight from
+# the probability arrays and without building a frame. CSV blocks are split
+# in chunks of block_rows rows which are formatted by 'n_jobs' parallel
+# workers when there are enough of them. The npz format keeps one array per
+# column and is written when the writer is closed. With 'precision',
+# probabilities are rounded to that number of decimals. The directory of
+# the file is created if needed.
+###############################################################################
+class ResultWriter(object):
+
+    def __init__(self, filename, precision=None, n_jobs=1):
+        self.filename = filename
+        self.format = output_format(filename)
+        self.precision = precision
+        self.n_jobs = max(n_jobs, 1)
+        self.nbr_rows = 0
+        self.blocks = []
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self.format == "csv.gz":
+            self.out_file = gzip.open(filename, "wb", gzip_level)
+        elif self.format == "csv":
+            self.out_file = open(filename, "wb")
+        else:
+            self.out_file = None
+        if self.out_file is not None:
+            self.out_file.write((",".join(output_columns) + "\n").encode("utf-8"))
+
+
+    def write(self, ids, pred_prob):
+        self.nbr_rows += len(ids)
+        if self.format == "npz":
+            if self.precision is not None:
+                pred_prob = round_values(pred_prob, self.precision) / 10.0 ** self.precision
+            self.blocks.append((np.asarray(ids), pred_prob))
+            return
+        starts = range(0, len(ids), block_rows)
+        if self.n_jobs > 1 and len(starts) > 1:
+            # joblib is slow to import, so it is imported only here
+            try:
+                from joblib                   import Parallel, delayed
+            except ImportError:
+                from sklearn.externals.joblib import Parallel, delayed
+            texts = Parallel(n_jobs=min(self.n_jobs, len(starts)))(
+                delayed(format_block)(ids[start:start + block_rows], \
+                                      pred_prob[start:start + block_rows], self.precision)
+                for start in starts)
+        else:
+            texts = (format_block(ids[start:start + block_rows], \
+                                  pred_prob[start:start + block_rows], self.precision)
+                     for start in starts)
+        for text in texts:
+            self.out_file.write(text)
+
+
+    def close(self):
+        if self.format == "npz":
+            if self.blocks:
+                ids = np.concatenate([block_ids for block_ids, _ in self.blocks])
+                pred_prob = np.concatenate([block_prob for _, block_prob in self.blocks])
+            else:
+                ids, pred_prob = np.array([], dtype=np.int64), np.zeros((0, 5))
+            columns = dict((name, pred_prob[:, i]) for i, name in enumerate(output_columns[1:]))
+            columns["ID"] = ids
+            with open(self.filename, "wb") as out_file:
+                np.savez(out_file, **columns)
+            self.blocks = []
+        elif self.out_file is not None:
+            self.out_file.close()
+            self.out_file = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+###############################################################################
+#                           WRITE RESULTS FUNCTION
+# Writes a whole submission file at once.
+###############################################################################
+def write_results(filename, ids, pred_prob, precision=None, n_jobs=1):
+    with ResultWriter(filename, precision, n_jobs) as writer:
+        writer.write(ids, pred_prob)
@@ -0,0 +1,212 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.stage_profiler -- Wall time, CPU time, memory and row counts per stage
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+'''
+
+import os
+import sys
+import csv
+import json
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Clocks: time.clock is gone from recent Pythons
+wall_clock = getattr(time, "perf_counter", time.time)
+cpu_clock  = getattr(time, "process_time", getattr(time, "clock", time.time))
+
+# Linux files giving the peak resident memory (VmHWM) and resetting it
+status_filename     = "/proc/self/status"
+clear_refs_filename = "/proc/self/clear_refs"
+
+# Columns of a profile, in the order they are written
+profile_columns = ["stage", "calls", "wall_seconds", "cpu_seconds", \
+                   "peak_rss_mb", "rss_growth_mb", "rows"]
+
+
+###############################################################################
+#                           PEAK RSS FUNCTION
+# Highest resident memory of this process in MB since it started or since
+# reset_peak_rss, or None where it cannot be found.
+###############################################################################
+def peak_rss():
+    try:
+        with open(status_filename) as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports it in KB, Mac OS in bytes
+    if sys.platform == "darwin":
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+###############################################################################
+#                           RESET PEAK RSS FUNCTION
+# Makes the peak resident memory start again from the current one. Only
+# Linux can do it, False is returned elsewhere.
+###############################################################################
+def reset_peak_rss():
+    try:
+        with open(clear_refs_filename, "w") as clear_refs_file:
+            clear_refs_file.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+###############################################################################
+#                               STAGE CLASS
+# Handle given to the body of a stage, which may set the number of rows it
+# handled.
+###############################################################################
+class Stage(object):
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+
+###############################################################################
+#                           STAGE PROFILER CLASS
+# Records each named stage of a run. Stages may be nested and are identified
+# by their path ("load_train/read_csv"). Stages run several times, like the
+# fitting of each fold, are accumulated in a single entry with their number
+# of calls. CPU time only counts this process, not parallel workers. Memory
+# is the peak resident memory of this process during the stage and how much
+# the stage made the peak of the whole run grow. The peak is reset when a
+# stage starts, and the peaks of nested stages are carried to the stage
+# around them. Where it cannot be reset (not Linux) the peak of a stage is
+# the peak of the process so far. With 'verbose' on, stages with a message
+# print it followed by their wall time.
+###############################################################################
+class StageProfiler(object):
+
+    def __init__(self, verbose=0):
+        self.verbose = verbose
+        self.reset()
+
+
+    def reset(self):
+        self.entries = {}
+        self.order = []
+        self.stack = []
+        # Peak memory of each open stage up to the last reset, and of the run
+        self.peaks = []
+        self.run_peak = None
+        self.started = time.time()
+        self.start_wall = wall_clock()
+
+
+    # Wall time in seconds since the profiler was reset
+    def elapsed(self):
+        return wall_clock() - self.start_wall
+
+
+    @contextmanager
+    def stage(self, name, message=None, rows=None):
+        stage = Stage(name, rows)
+        self.stack.append(name)
+        path = "/".join(self.stack)
+        show = self.verbose > 0 and message is not None
+        if show:
+            sys.stdout.write("%-50s " % message)
+            sys.stdout.flush()
+
+        self.note_peak(peak_rss())
+        start_run_peak = self.run_peak
+        reset_peak_rss()
+        self.peaks.append(peak_rss())
+        start_cpu  = cpu_clock()
+        start_wall = wall_clock()
+        try:
+            yield stage
+        finally:
+            wall = wall_clock() - start_wall
+            cpu  = cpu_clock() - start_cpu
+            end_rss = peak_rss()
+            if end_rss is not None:
+                end_rss = max(end_rss, self.peaks[-1])
+            self.peaks.pop()
+            self.note_peak(end_rss)
+            self.stack.pop()
+            self.add(path, wall, cpu, end_rss, \
+                     None if end_rss is None else self.run_peak - start_run_peak, stage.rows)
+            if show:
+                print("--> %8.3f seconds" % wall)
+
+
+    # Carries a peak memory to the open stage and to the run
+    def note_peak(self, rss):
+        if rss is None:
+            return
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], rss)
+        self.run_peak = rss if self.run_peak is None else max(self.run_peak, rss)
+
+
+    # Accumulates 'calls' calls of a stage
+    def add(self, path, wall, cpu, rss, rss_growth, rows, calls=1):
+        if path not in self.entries:
+            self.order.append(path)
+            self.entries[path] = {"stage": path, "calls": 0, "wall_seconds": 0.0, \
+                                  "cpu_seconds": 0.0, "peak_rss_mb": rss, \
+                                  "rss_growth_mb": rss_growth, "rows": rows}
+        else:
+            entry = self.entries[path]
+            if rss is not None:
+                entry["peak_rss_mb"] = max(entry["peak_rss_mb"], rss)
+                entry["rss_growth_mb"] += rss_growth
+            if rows is not None:
+                entry["rows"] = (entry["rows"] or 0) + rows
+        entry = self.entries[path]
+        entry["calls"] += calls
+        entry["wall_seconds"] += wall
+        entry["cpu_seconds"] += cpu
+
+
+    # Recorded stages in the order they started
+    def stages(self):
+        return [self.entries[path] for path in self.order]
+
+
+    # Writes the profile as CSV if filename ends with .csv, otherwise as JSON
+    def save(self, filename, info=None):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if filename.endswith(".csv"):
+            with open(filename, "w") as profile_file:
+                writer = csv.DictWriter(profile_file, profile_columns, lineterminator="\n")
+                writer.writeheader()
+                writer.writerows(self.stages())
+        else:
+            self.note_peak(peak_rss())
+            profile = {"started"      : time.strftime("%Y-%m-%dT%H:%M:%S", \
+                                                      time.localtime(self.started)),
+                       "total_seconds": self.elapsed(),
+                       "peak_rss_mb"  : self.run_peak,
+                       "info"         : info,
+                       "stages"       : self.stages()}
+            with open(filename, "w") as profile_file:
+                json.dump(profile, profile_file, indent=2)
@@ -0,0 +1,144 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.synth_data -- Synthetic shelter intake files of any size
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    python synth_data.py 1M ../benchmarks/data/train_1M.csv
+    python synth_data.py 500k ../benchmarks/data/test_500k.csv --kind test
+'''
+
+import sys
+import numpy as np
+import pandas as datafile
+from argparse import ArgumentParser
+
+
+###############################################################################
+#                           SOME PARAMETERS
+###############################################################################
+
+# Columns of train and test files
+train_columns = ["AnimalID", "Name", "DateTime", "OutcomeType", "OutcomeSubtype", \
+                 "AnimalType", "SexuponOutcome", "AgeuponOutcome", "Breed", "Color"]
+test_columns  = ["ID", "Name", "DateTime", "AnimalType", "SexuponOutcome", \
+                 "AgeuponOutcome", "Breed", "Color"]
+
+# Attributes always drawn together from the same source row, so the links
+# between animal type, sex, age and outcome are kept
+joint_att = ["AnimalType", "SexuponOutcome", "AgeuponOutcome", "OutcomeType", \
+             "OutcomeSubtype"]
+
+# Attributes drawn each one from another source row of the same animal type
+per_type_att = ["Breed", "Color", "Name"]
+
+# Rows generated and written at a time
+default_chunk_rows = 1000000
+
+
+###############################################################################
+#                           PARSE ROWS FUNCTION
+# Number of rows from strings like "25000", "100k" or "50M".
+###############################################################################
+def parse_rows(text):
+    multipliers = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000}
+    if text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+
+###############################################################################
+#                       SHELTER GENERATOR CLASS
+# Draws synthetic rows from the empirical distributions of a real train file.
+# Type, sex, age and outcome come together from one random source row. Breed,
+# color and name come from other random rows of the same animal type, so
+# their cardinality, frequencies and NaN rates are those of the source file
+# while new combinations show up. Outcome times are uniform over the source
+# date range, rounded to the minute.
+###############################################################################
+class ShelterGenerator(object):
+
+    def __init__(self, source_filename, seed=1000):
+        source = datafile.read_csv(source_filename, dtype=str)
+        self.values = dict((column, source[column].values.astype(object)) \
+                           for column in source.columns)
+        self.nbr_source_rows = len(source)
+        animal_types = self.values["AnimalType"]
+        self.type_rows = dict((animal_type, np.flatnonzero(animal_types == animal_type)) \
+                              for animal_type in np.unique(animal_types))
+        dates = datafile.to_datetime(source["DateTime"]).values.astype("datetime64[s]")
+        self.first_date = dates.min().astype(np.int64)
+        self.last_date  = dates.max().astype(np.int64)
+        self.random_state = np.random.RandomState(seed)
+
+
+    # Generates 'nbr_rows' rows whose ids start at 'first_id'
+    def chunk(self, nbr_rows, first_id, kind="train"):
+        random_state = self.random_state
+        rows = random_state.randint(0, self.nbr_source_rows, nbr_rows)
+        columns = dict((column, self.values[column].take(rows)) for column in joint_att)
+
+        for column in per_type_att:
+            rows = np.empty(nbr_rows, dtype=np.intp)
+            for animal_type, type_rows in self.type_rows.items():
+                mask = columns["AnimalType"] == animal_type
+                rows[mask] = type_rows.take(random_state.randint(0, len(type_rows), mask.sum()))
+            columns[column] = self.values[column].take(rows)
+
+        seconds = self.first_date + (random_state.random_sample(nbr_rows) * \
+                  (self.last_date - self.first_date)).astype(np.int64)
+        columns["DateTime"] = datafile.to_datetime(seconds // 60 * 60, unit="s")\
+                                      .strftime("%Y-%m-%d %H:%M:%S")
+
+        ids = datafile.Series(np.arange(first_id, first_id + nbr_rows))
+        if kind == "train":
+            columns["AnimalID"] = "A" + ids.astype(str).values
+            return datafile.DataFrame(columns, columns=train_columns)
+        columns["ID"] = ids.values
+        return datafile.DataFrame(columns, columns=test_columns)
+
+
+    # Writes a file of 'nbr_rows' rows, one chunk at a time
+    def generate(self, filename, nbr_rows, kind="train", chunk_rows=default_chunk_rows):
+        first_id = 1
+        with open(filename, "w") as out_file:
+            while first_id <= nbr_rows:
+                chunk = self.chunk(min(chunk_rows, nbr_rows - first_id + 1), first_id, kind)
+                chunk.to_csv(out_file, index=False, header=(first_id == 1))
+                first_id += len(chunk)
+
+
+###############################################################################
+#                           GENERATE FILE FUNCTION
+###############################################################################
+def generate_file(source_filename, filename, nbr_rows, kind="train", seed=1000, \
+                  chunk_rows=default_chunk_rows):
+    ShelterGenerator(source_filename, seed).generate(filename, nbr_rows, kind, chunk_rows)
+
+
+###############################################################################
+#                               MAIN FUNCTION
+###############################################################################
+def main(argv=None):
+    parser = ArgumentParser(prog="synth_data.py")
+    parser.add_argument("rows"  , help="number of rows, like 25000, 100k or 50M")
+    parser.add_argument("output", help="output CSV file")
+    parser.add_argument("--kind"      , default="train", choices=["train", "test"], help="train file with outcomes or test file with integer ids (default: train)")
+    parser.add_argument("--source"    , default="../data/train.csv", help="real train file whose distributions are copied (default: ../data/train.csv)")
+    parser.add_argument("--seed"      , default=1000, type=int, help="random seed (default: 1000)")
+    parser.add_argument("--chunk-rows", dest="chunk_rows", default=default_chunk_rows, type=int, help="rows generated at a time (default: %d)" % default_chunk_rows)
+    args = parser.parse_args(argv)
+
+    generate_file(args.source, args.output, parse_rows(args.rows), args.kind, args.seed, \
+                  args.chunk_rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.test_animal_out -- Checks of the train/test files rebuilt by animal_out
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    python -m pytest test_animal_out.py
+'''
+
+import os
+import pandas as datafile
+import pytest
+import animal_out
+
+from pandas.testing import assert_frame_equal
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+
+###############################################################################
+#                       ROW WISE NEW FILE FUNCTION
+# get_new_file as it was before the features were compiled: each feature is
+# derived row by row with apply.
+###############################################################################
+def row_wise_new_file(filename, nanfill):
+    csv_file = datafile.read_csv(filename)
+    if "AnimalID" in csv_file.columns:
+        csv_file = csv_file.rename(columns = {"AnimalID":"ID"})
+        csv_file["ID"] = csv_file["ID"].apply(lambda x: x.split("A")[1])
+
+    if (nanfill == True):
+        csv_file = csv_file.fillna(-1)
+    else:
+        data_with_nan = csv_file.isnull().any()
+        data_with_nan = data_with_nan.drop(["ID", "Name", "DateTime"])
+        csv_file_aux = csv_file.dropna()
+        for column_with_nan in data_with_nan.index:
+            if (data_with_nan[column_with_nan] == True):
+                mean_value = csv_file_aux[column_with_nan].value_counts().index[0]
+                csv_file[column_with_nan] = csv_file[column_with_nan].fillna(mean_value)
+
+    csv_file["DaysUponOutcome"] = animal_out.age_to_days(csv_file["AgeuponOutcome"].values)
+    csv_file.drop("AgeuponOutcome", axis=1, inplace = True)
+    csv_file["Sex"] = csv_file["SexuponOutcome"].apply(animal_out.get_sex)
+    csv_file["Neutered"] = csv_file["SexuponOutcome"].apply(animal_out.get_neutered)
+    csv_file.drop("SexuponOutcome", axis=1, inplace = True)
+    csv_file["isMix"] = csv_file["Breed"].apply(lambda x: "Mix" in x)
+    csv_file["singleBreed"] = csv_file["Breed"].apply(lambda x: x.split("/")[0])
+    csv_file["singleBreed"] = csv_file["singleBreed"].apply(lambda x: x.split(" Mix")[0])
+    csv_file.drop("Breed", axis=1, inplace = True)
+    csv_file["singleColor"] = csv_file["Color"].apply(lambda x: x.split("/")[0])
+    csv_file["nbrofColors"] = csv_file["Color"].apply(lambda x: len((x.split("/"))))
+    csv_file.drop("Color", axis=1, inplace = True)
+    csv_file["hasName"] = csv_file["Name"].apply(lambda x: type(x) is str)
+    csv_file.drop("Name", axis=1, inplace = True)
+    return csv_file
+
+
+@pytest.mark.parametrize("nanfill", [False, True])
+@pytest.mark.parametrize("name", ["train.csv", "test.csv"])
+def test_compiled_features_equal_row_wise(monkeypatch, name, nanfill):
+    monkeypatch.setattr(animal_out, "nanfill", nanfill)
+    monkeypatch.setattr(animal_out, "chunksize", 0)
+    monkeypatch.setattr(animal_out, "date_features", False)
+    monkeypatch.setattr(animal_out, "breed_encoding", "ordinal")
+    filename = os.path.join(data_dir, name)
+    if not os.path.isfile(filename):
+        pytest.skip("%s is not in the data directory" % name)
+    assert_frame_equal(animal_out.get_new_file(filename), row_wise_new_file(filename, nanfill))
@@ -0,0 +1,64 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.test_forest_inference -- Checks of the flat forests of forest_inference
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    python -m pytest test_forest_inference.py
+'''
+
+import numpy as np
+import pytest
+import forest_inference
+
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from sklearn.tree     import DecisionTreeClassifier
+from forest_inference import FlatForest
+
+
+###############################################################################
+#                           SHELTER LIKE DATA
+# Integer codes like the nominal attributes of the train file, one
+# continuous attribute like DaysUponOutcome and five outcomes.
+###############################################################################
+def shelter_like_data(nbr_rows=3000):
+    random_state = np.random.RandomState(1000)
+    cardinality = [60, 220, 2, 3, 3, 2, 2, 3, 50]
+    X = np.column_stack([random_state.randint(0, c, nbr_rows) for c in cardinality] + \
+                        [random_state.exponential(700.0, nbr_rows)])
+    y = (X[:, 0] + 3 * X[:, 4] + (X[:, -1] > 365) + random_state.randint(0, 20, nbr_rows)) % 5
+    return X, y
+
+
+classifiers = [RandomForestClassifier(n_estimators=20, max_features="sqrt", random_state=1000),
+               ExtraTreesClassifier(n_estimators=20, max_features="sqrt", random_state=1000),
+               DecisionTreeClassifier(max_features="sqrt", random_state=1000)]
+
+
+@pytest.mark.parametrize("classif", classifiers, ids=lambda classif: type(classif).__name__)
+def test_flat_forest_matches_predict_proba(classif):
+    X, y = shelter_like_data()
+    classif.fit(X[:2000], y[:2000])
+    assert forest_inference.is_supported(classif)
+    flat_forest = FlatForest(classif)
+    assert np.allclose(flat_forest.predict_proba(X), classif.predict_proba(X))
+    assert (flat_forest.predict(X) == classif.predict(X)).all()
+
+
+@pytest.mark.parametrize("classif", classifiers, ids=lambda classif: type(classif).__name__)
+def test_flat_forest_blocks_and_threads(monkeypatch, classif):
+    X, y = shelter_like_data()
+    classif.fit(X[:2000], y[:2000])
+    # A few rows per block, so rows are split in many blocks
+    monkeypatch.setattr(forest_inference, "block_cells", 200)
+    flat_forest = FlatForest(classif)
+    expected = classif.predict_proba(X)
+    for n_threads in (1, 3):
+        assert np.allclose(flat_forest.predict_proba(X, n_threads), expected)
+    assert np.allclose(flat_forest.predict_proba(X[:1], 3), expected[:1])
@@ -0,0 +1,80 @@
+#!/usr/local/bin/python2.7
+# encoding: utf-8
+'''
+src.test_result_writer -- Checks of the submission files written by result_writer
+
+@author:     Laercio, Pedro and Lucca
+@copyright:  2016 ICMC. All rights reserved.
+@license:    license
+@contact:    leoabubauru@hotmail.com
+@deffield    updated: Updated
+
+Usage:
+    python -m pytest test_result_writer.py
+'''
+
+import os
+import numpy as np
+import result_writer
+
+
+###############################################################################
+#                           TIE HEAVY PROBABILITIES
+# Fractions k/n with small n: many of them are halfway between two decimals
+# of the precisions checked, exactly or after the binary rounding.
+###############################################################################
+def tie_probabilities():
+    fractions = [k / float(n) for n in (2, 4, 8, 16, 20, 40, 125, 200, 1000, 2000, 20000)
+                 for k in range(n + 1)]
+    fractions += [0.005, 0.015, 0.025, 0.035, 0.045, 0.0005, 0.0015, 0.00005, 0.125, 0.375]
+    fractions += [0.5 - 1e-17, 0.005000000000000001, 0.004999999999999999]
+    nbr_rows = -(-len(fractions) // 5)
+    values = np.resize(np.array(fractions), nbr_rows * 5).reshape(nbr_rows, 5)
+    return np.arange(1, nbr_rows + 1) * 7, values
+
+
+def printf_block(ids, pred_prob, precision):
+    value_format = "%%.%df" % precision
+    return "".join(",".join(["%d" % row_id] + [value_format % value for value in row]) + "\n"
+                   for row_id, row in zip(ids.tolist(), pred_prob.tolist())).encode("utf-8")
+
+
+def test_fixed_block_rounds_ties_like_printf():
+    ids, pred_prob = tie_probabilities()
+    for precision in range(0, 9):
+        assert result_writer.format_block(ids, pred_prob, precision) == \
+            printf_block(ids, pred_prob, precision), precision
+
+
+def test_fixed_block_half_cent():
+    ids = np.array([1])
+    assert result_writer.format_block(ids, np.array([[0.005] * 5]), 2) == \
+        b"1,0.01,0.01,0.01,0.01,0.01\n"
+
+
+def test_fixed_block_random_values_like_printf():
+    ids = np.arange(10000)
+    pred_prob = np.random.RandomState(0).dirichlet(np.ones(5), size=len(ids))
+    for precision in (1, 3, 6):
+        assert result_writer.format_block(ids, pred_prob, precision) == \
+            printf_block(ids, pred_prob, precision)
+
+
+def test_npz_rounds_like_printf(tmpdir):
+    ids, pred_prob = tie_probabilities()
+    for precision in (2, 3, 4):
+        filename = os.path.join(str(tmpdir), "result_%d.npz" % precision)
+        result_writer.write_results(filename, ids, pred_prob, precision)
+        columns = np.load(filename)
+        assert (columns["ID"] == ids).all()
+        for i, name in enumerate(result_writer.output_columns[1:]):
+            expected = [float("%.*f" % (precision, value)) for value in pred_prob[:, i]]
+            assert columns[name].tolist() == expected
+
+
+def test_writer_creates_directory(tmpdir):
+    filename = os.path.join(str(tmpdir), "out", "score_result.csv")
+    result_writer.write_results(filename, np.array([1]), np.array([[1.0, 0.0, 0.0, 0.0, 0.0]]))
+    with open(filename, "rb") as result_file:
+        assert result_file.read() == b"ID,Adoption,Died,Euthanasia,Return_to_owner,Transfer\n" \
+                                     b"1,1.0,0.0,0.0,0.0,0.0\n"